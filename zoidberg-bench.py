@@ -0,0 +1,393 @@
+import subprocess
+import threading
+import argparse
+import tempfile
+import shutil
+import json
+import yaml
+import time
+import sys
+import os
+
+# Run with --stub <name>, this script stands in for that command on the
+# simulated fleet instead of running the benchmark
+stub_commands = ['ssh', 'scp', 'rsync', 'systemctl', 'apt-get', 'pip', 'sudo',
+                 'dpkg-query', 'shutdown', 'update-alternatives']
+ssh_value_options = ['-o', '-O', '-L', '-R', '-D', '-p', '-i', '-l', '-F', '-S', '-W', '-E', '-c', '-m', '-b']
+default_host_counts = '1,10,100,500'
+default_operations = 'install,update,restart,status --compact,ping'
+
+
+def get_bench_dir():
+    '''Gets the directory of the benchmark run a stub belongs to'''
+    return os.environ['ZOIDBERG_BENCH_DIR']
+
+
+def get_host_dir(host):
+    '''Gets the sandbox that stands in for the home directory of a simulated host'''
+    return get_bench_dir() + '/hosts/' + host.split('@')[-1]
+
+
+def record_stub(name, transferred):
+    '''Records one stub process, and the bytes it moved, for the benchmark to count'''
+    with open(get_bench_dir() + '/stats.log', 'a') as stream:
+        stream.write(name + ' ' + str(transferred) + '\n')
+
+
+def thread_pump(source, target, counter):
+    '''Worker which copies a stream to another as data arrives, counting the bytes'''
+    while True:
+        data = os.read(source.fileno(), 65536)
+        if len(data) == 0:
+            break
+        counter.append(len(data))
+        target.write(data)
+        target.flush()
+    target.close()
+
+
+def stub_ssh(args):
+    '''Runs a command on a simulated host, as ssh would over a control master'''
+    options = dict()
+    while len(args) > 0 and args[0].startswith('-'):
+        option = args.pop(0)
+        if option in ssh_value_options:
+            options[option] = args.pop(0)
+
+    host = args.pop(0)
+    host_dir = get_host_dir(host)
+    os.makedirs(host_dir, exist_ok=True)
+
+    if options.get('-O') == 'forward':
+        local_socket, remote_socket = options['-L'].split(':', 1)
+        os.symlink(remote_socket, local_socket)
+        return 0
+    if '-O' in options:
+        return 0
+
+    command = ' '.join(args)
+    env = dict(os.environ, HOME=host_dir)
+
+    if 'git-receive-pack' in command or 'git-upload-pack' in command:
+        # git talks back and forth over the connection, so pass it through as it goes
+        process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, env=env, cwd=host_dir)
+        counter = []
+        sender = threading.Thread(target=thread_pump, args=(sys.stdin.buffer, process.stdin, counter))
+        sender.start()
+        thread_pump(process.stdout, sys.stdout.buffer, counter)
+        returncode = process.wait()
+        record_stub('ssh', sum(counter))
+        return returncode
+
+    data = sys.stdin.buffer.read()
+    process = subprocess.Popen(['sh', '-c', command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, env=env, cwd=host_dir)
+    process.stdin.write(data)
+    process.stdin.close()
+
+    transferred = len(data)
+    for line in process.stdout:
+        transferred += len(line)
+        sys.stdout.buffer.write(line)
+        sys.stdout.flush()
+
+    returncode = process.wait()
+    record_stub('ssh', transferred)
+    return returncode
+
+
+def get_remote_path(target):
+    '''Maps a host:path argument to the path itself, as every simulated host's
+    root already lies within its sandbox'''
+    if ':' not in target:
+        return target
+    return target.split(':', 1)[1]
+
+
+def sync_tree(source, target):
+    '''Copies a directory like rsync -a --delete would, only sending files whose
+    size or modification time differ, and skipping hidden ones. Returns the
+    number of bytes sent.'''
+    transferred = 0
+    wanted = set()
+    os.makedirs(target, exist_ok=True)
+
+    for directory, directories, files in os.walk(source):
+        directories[:] = [name for name in directories if not name.startswith('.')]
+        relative = os.path.relpath(directory, source)
+        target_directory = os.path.normpath(os.path.join(target, relative))
+        os.makedirs(target_directory, exist_ok=True)
+        wanted.add(target_directory)
+
+        for name in files:
+            if name.startswith('.'):
+                continue
+
+            source_path = os.path.join(directory, name)
+            target_path = os.path.join(target_directory, name)
+            wanted.add(target_path)
+            stat = os.stat(source_path)
+
+            if os.path.exists(target_path):
+                target_stat = os.stat(target_path)
+                if target_stat.st_size == stat.st_size and int(target_stat.st_mtime) == int(stat.st_mtime):
+                    continue
+
+            # Replace rather than edit, so hard linked releases keep their copy
+            if os.path.lexists(target_path):
+                os.remove(target_path)
+            shutil.copy2(source_path, target_path)
+            transferred += stat.st_size
+
+    for directory, directories, files in os.walk(target, topdown=False):
+        for name in files + directories:
+            path = os.path.join(directory, name)
+            if path in wanted:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    return transferred
+
+
+def stub_rsync(args):
+    '''Syncs a local directory to a simulated host'''
+    positional = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg in ['-e', '--rsync-path', '--exclude']:
+            args.pop(0)
+        elif not arg.startswith('-'):
+            positional.append(arg)
+
+    source, target = positional[-2], positional[-1]
+    record_stub('rsync', sync_tree(get_remote_path(source), get_remote_path(target)))
+    return 0
+
+
+def stub_scp(args):
+    '''Copies files to a simulated host'''
+    paths = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg in ['-o', '-P', '-i', '-F']:
+            args.pop(0)
+        elif not arg.startswith('-'):
+            paths.append(get_remote_path(arg))
+
+    transferred = 0
+    for path in paths[:-1]:
+        shutil.copy(path, paths[-1])
+        transferred += os.path.getsize(path)
+    record_stub('scp', transferred)
+    return 0
+
+
+def stub_systemctl(args):
+    '''Answers systemctl as though every unit were running fine'''
+    record_stub('systemctl', 0)
+    units = [arg for arg in args if not arg.startswith('-') and arg not in ['show', 'is-active']]
+
+    if 'show' in args:
+        # The value of -p is among the units, but has no unit of its own
+        units = units[1:]
+        entered = str(int(max(0, time.monotonic() - 60) * 1000000))
+        print('\n\n'.join('Id=' + unit + '.service\nLoadState=loaded\nActiveState=active\n' +
+                          'SubState=running\nActiveEnterTimestampMonotonic=' + entered +
+                          '\nMemoryCurrent=1048576' for unit in units))
+    elif 'is-active' in args:
+        print('\n'.join('active' for _ in units))
+
+    return 0
+
+
+def stub_sudo(args):
+    '''Runs a command as though it were root'''
+    record_stub('sudo', 0)
+    return subprocess.call(args)
+
+
+def run_stub(name, args):
+    '''Runs this script as the stub for one of the fleet's commands'''
+    if name == 'ssh':
+        return stub_ssh(args)
+    elif name == 'rsync':
+        return stub_rsync(args)
+    elif name == 'scp':
+        return stub_scp(args)
+    elif name == 'systemctl':
+        return stub_systemctl(args)
+    elif name == 'sudo':
+        return stub_sudo(args)
+
+    # Nothing is installed as far as dpkg knows, and installing always works
+    record_stub(name, 0)
+    return 1 if name == 'dpkg-query' else 0
+
+
+def create_bin_dir(bench_dir):
+    '''Writes a wrapper for every stub command, and links python, into a
+    directory to put first on the PATH'''
+    bin_dir = bench_dir + '/bin'
+    os.makedirs(bin_dir)
+
+    for name in stub_commands:
+        with open(bin_dir + '/' + name, 'w') as stream:
+            stream.write('#!/bin/sh\nexec \'' + sys.executable + '\' \'' + os.path.abspath(__file__) +
+                         '\' --stub ' + name + ' "$@"\n')
+        os.chmod(bin_dir + '/' + name, 0o755)
+    os.symlink(sys.executable, bin_dir + '/python')
+
+    return bin_dir
+
+
+def create_upstream(bench_dir):
+    '''Creates a local bare repository with a small service in it, to use as the source'''
+    work_dir = bench_dir + '/upstream-work'
+    upstream = bench_dir + '/upstream/app.git'
+    os.makedirs(work_dir)
+
+    with open(work_dir + '/main.py', 'w') as stream:
+        stream.write('print(\'Hello from the bench\')\n')
+    with open(work_dir + '/app.service', 'w') as stream:
+        stream.write('[Service]\nExecStart=python main.py\n')
+    with open(work_dir + '/prereqs.yaml', 'w') as stream:
+        stream.write('apt:\n    - libbench0\npip:\n    - bench-package\n' +
+                     'setup:\n    - echo setup\nupdate:\n    - echo update\n')
+
+    env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+               GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    for command in [['git', 'init', '-q', '-b', 'master'], ['git', 'add', '-A'],
+                    ['git', 'commit', '-q', '-m', 'Bench service']]:
+        subprocess.check_call(command, cwd=work_dir, env=env)
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work_dir, upstream])
+
+    return upstream
+
+
+def write_config(bench_dir, host_count, upstream, parallel):
+    '''Writes a config with one service on each of the simulated hosts'''
+    config = {'hosts': dict(), 'sources': {'app': {'source': upstream, 'branch': 'master'}},
+              'services': dict(), 'settings': {'parallel': parallel}}
+
+    for index in range(host_count):
+        host = 'host' + str(index)
+        ip = '10.0.' + str(index // 250) + '.' + str(index % 250 + 1)
+        host_dir = bench_dir + '/hosts/' + ip
+        config['hosts'][host] = {'ip': ip, 'root': host_dir + '/zoidberg-deploy',
+                                 'systemd_dir': host_dir + '/.config/systemd/user'}
+        config['services']['app' + str(index)] = {'source': 'app', 'host': host}
+
+    config_path = bench_dir + '/zbc.yaml'
+    with open(config_path, 'w') as stream:
+        yaml.safe_dump(config, stream)
+    return config_path
+
+
+def read_stats(bench_dir):
+    '''Reads and clears the record of stub processes and bytes moved'''
+    processes = dict()
+    transferred = 0
+    stats_path = bench_dir + '/stats.log'
+
+    if os.path.exists(stats_path):
+        with open(stats_path, 'r') as stream:
+            for line in stream:
+                name, count = line.split()
+                processes[name] = processes.get(name, 0) + 1
+                transferred += int(count)
+        os.remove(stats_path)
+
+    return processes, transferred
+
+
+def run_benchmark(bench_dir, config_path, bin_dir, operation):
+    '''Runs one zoidberg operation on the simulated fleet, timing it'''
+    env = dict(os.environ, ZOIDBERG_BENCH_DIR=bench_dir, HOME=bench_dir + '/home',
+               PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    log_path = bench_dir + '/' + operation.split()[0] + '.log'
+    zoidberg = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zoidberg.py')
+
+    started = time.time()
+    with open(log_path, 'a') as log:
+        returncode = subprocess.call([sys.executable, zoidberg, config_path] + operation.split(),
+                                     stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                     env=env, cwd=os.path.dirname(zoidberg))
+    wall = time.time() - started
+
+    processes, transferred = read_stats(bench_dir)
+    return {'operation': operation, 'ok': returncode == 0, 'wall': round(wall, 3),
+            'processes': sum(processes.values()), 'process_counts': processes,
+            'bytes': transferred, 'log': log_path}
+
+
+def bench_fleet(host_count, operations, parallel, keep):
+    '''Builds a fresh simulated fleet of some size, and benchmarks each operation on it in turn'''
+    bench_dir = tempfile.mkdtemp(prefix='zoidberg-bench-')
+    results = []
+
+    try:
+        os.makedirs(bench_dir + '/home')
+        bin_dir = create_bin_dir(bench_dir)
+        upstream = create_upstream(bench_dir)
+        config_path = write_config(bench_dir, host_count, upstream, parallel)
+
+        for operation in operations:
+            result = run_benchmark(bench_dir, config_path, bin_dir, operation)
+            result['hosts'] = host_count
+            results.append(result)
+    finally:
+        if not keep:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    return results, bench_dir
+
+
+def print_results(results):
+    '''Prints the benchmark results as a table'''
+    table = [['hosts', 'operation', 'ok', 'seconds', 'processes', 'bytes']] + \
+        [[str(result['hosts']), result['operation'], 'yes' if result['ok'] else 'NO',
+          '%.2f' % result['wall'], str(result['processes']), str(result['bytes'])]
+         for result in results]
+    widths = [max(len(line[column]) for line in table) for column in range(len(table[0]))]
+
+    for line in table:
+        print('  '.join(value.ljust(width) if column < 3 else value.rjust(width)
+                        for column, (value, width) in enumerate(zip(line, widths))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--stub':
+        sys.exit(run_stub(sys.argv[2], sys.argv[3:]))
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks zoidberg operations on a simulated fleet of local hosts')
+    parser.add_argument('--hosts', default=default_host_counts,
+                        help='Comma separated numbers of hosts to simulate')
+    parser.add_argument('--operations', default=default_operations,
+                        help='Comma separated operations, with any arguments, to run in order on each fleet')
+    parser.add_argument('--parallel', type=int, default=10,
+                        help='Maximum number of hosts zoidberg works on at once')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the simulated fleets, and the logs of each operation, for inspection')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args()
+
+    all_results = []
+    for host_count in [int(count) for count in args.hosts.split(',')]:
+        results, bench_dir = bench_fleet(host_count, args.operations.split(','), args.parallel, args.keep)
+        all_results.extend(results)
+        if args.keep and not args.json:
+            print('Kept the fleet of ' + str(host_count) + ' hosts in ' + bench_dir)
+
+    if args.json:
+        print(json.dumps(all_results, indent=4))
+    else:
+        print_results(all_results)
+
+    if not all(result['ok'] for result in all_results):
+        sys.exit(1)
@@ -1,104 +1,710 @@
 import argparse
 import subprocess
+import sys
+import socket
 import yaml
 import os
+import threading
+import hashlib
+import time
+import json
+import shlex
+import re
+import pickle
+from importlib import metadata
+from concurrent.futures import ThreadPoolExecutor
 
 root_dir = '/home/pi/zoidberg-deploy'
+systemd_dir = '/home/pi/.config/systemd/user'
+systemctl_modes = ['batch', 'concurrent', 'serial']
+systemctl_mode = 'batch'
+systemctl_parallel = 8
+default_health_timeout = 30
+health_timeout = default_health_timeout
+health_interval = 1
+default_scripts_parallel = 4
+scripts_parallel = default_scripts_parallel
+status_properties = ['Id', 'LoadState', 'ActiveState', 'SubState',
+                     'ActiveEnterTimestampMonotonic', 'MemoryCurrent']
+output_lock = threading.Lock()
+fetched_caches = dict()
+offline = False
+default_keep_releases = 3
+keep_releases = default_keep_releases
+prereqs_manifest = root_dir + '/.cache/prereqs.json'
+wheels_dir = root_dir + '/wheels'
+loaded_files = dict()
+config_cache_dir = root_dir + '/.cache/configs'
+units_manifest = root_dir + '/.cache/units.json'
+system_unit_dirs = ['/etc/systemd/system', '/run/systemd/system',
+                    '/lib/systemd/system', '/usr/lib/systemd/system']
+config_cache_version = 2
+daemon_running = False
+emit_events = False
+step_starts = dict()
+failed_steps = 0
+
+
+def load_yaml(path):
+    # Parsed files are kept for as long as they're unchanged, which lets the
+    # daemon skip parsing on repeat requests
+    real_path = os.path.realpath(path)
+    modified = os.stat(real_path).st_mtime_ns
+
+    if real_path in loaded_files and loaded_files[real_path][0] == modified:
+        return loaded_files[real_path][1]
+
+    with open(real_path, 'r') as stream:
+        loaded = yaml.load(stream, Loader=get_yaml_loader())
+
+    loaded_files[real_path] = (modified, loaded)
+    return loaded
+
+
+def get_yaml_loader():
+    # libyaml's loader is many times faster, where it is installed
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def index_config(config):
+    # Lookups between hosts, sources and services, so nothing has to scan
+    # every service to find the ones it wants
+    index = {'host_services': dict(), 'source_services': dict(), 'service_host': dict()}
+
+    # Older configs named the sources section source
+    if 'sources' not in config and 'source' in config:
+        config['sources'] = config.pop('source')
+
+    for service, service_config in (config.get('services') or {}).items():
+        service_config = service_config or {}
+        host = service_config.get('host')
+        index['service_host'][service] = host
+        index['host_services'].setdefault(host, []).append(service)
+        if 'source' in service_config:
+            index['source_services'].setdefault(service_config['source'], []).append(service)
+
+    config['_index'] = index
+    return config
+
+
+def load_config(path):
+    # Configs are compiled to a pickle with their indexes, which is reused
+    # for as long as the file's mtime and size, or failing that its hash,
+    # are unchanged
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+
+    if real_path in loaded_files and loaded_files[real_path][0] == stat.st_mtime_ns:
+        return loaded_files[real_path][1]
+
+    cache_path = config_cache_dir + '/' + \
+        hashlib.sha1(real_path.encode()).hexdigest()[:16] + '.pickle'
+    compiled = None
+    try:
+        with open(cache_path, 'rb') as stream:
+            compiled = pickle.load(stream)
+        if compiled['version'] != config_cache_version:
+            compiled = None
+    except Exception:
+        compiled = None
+
+    if compiled is not None and compiled['mtime'] == stat.st_mtime_ns and compiled['size'] == stat.st_size:
+        config = compiled['config']
+    else:
+        with open(real_path, 'rb') as stream:
+            data = stream.read()
+        file_hash = hashlib.sha1(data).hexdigest()
+
+        if compiled is not None and compiled['hash'] == file_hash:
+            config = compiled['config']
+        else:
+            config = index_config(yaml.load(data, Loader=get_yaml_loader()))
+
+        try:
+            os.makedirs(config_cache_dir, exist_ok=True)
+            temp_path = cache_path + '.' + str(os.getpid())
+            with open(temp_path, 'wb') as stream:
+                pickle.dump({'version': config_cache_version, 'mtime': stat.st_mtime_ns,
+                             'size': stat.st_size, 'hash': file_hash, 'config': config}, stream)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            print('Couldn\'t cache the config: ' + str(e))
+
+    loaded_files[real_path] = (stat.st_mtime_ns, config)
+    return config
+
+
+def load_prereqs(target_dir):
+    source_config_file = target_dir + '/prereqs.yaml'
+    if not os.path.exists(source_config_file):
+        return None
+    return load_yaml(source_config_file)
+
+
+def report(status, step, subject=None, error=None):
+    # Reports a step as a line of text, or as an EVENT line of JSON for the
+    # controller to aggregate, timing each step from its START
+    global failed_steps
+
+    now = time.time()
+    key = (step, subject)
+    duration = None
+    if status == 'START':
+        step_starts[key] = now
+    elif key in step_starts:
+        duration = now - step_starts.pop(key)
+
+    if status == 'ERROR':
+        failed_steps += 1
+
+    if not emit_events:
+        if error is not None:
+            print(error)
+        print(status + ' ' + step + ('' if subject is None else ' ' + subject), flush=True)
+        return
+
+    event = {'status': status, 'step': step, 'subject': subject, 'time': round(now, 3)}
+    if duration is not None:
+        event['duration'] = round(duration, 3)
+    if isinstance(error, subprocess.CalledProcessError):
+        event['exit_code'] = error.returncode
+    if error is not None:
+        event['error'] = str(error)
+    print('EVENT ' + json.dumps(event), flush=True)
+
+
+def report_time(step, subject, started):
+    # Reports how long a phase within a step took, for the controller's
+    # profile of the run; there is nothing to show for it as text
+    if emit_events:
+        print('EVENT ' + json.dumps({'status': 'TIME', 'step': step, 'subject': subject,
+                                     'duration': round(time.time() - started, 3)}), flush=True)
+
+
+def get_systemctl_command(is_system, command):
+    if is_system:
+        return ['sudo', 'systemctl', command]
+    else:
+        return ['systemctl', '--user', command]
+
 
+def get_unit_path(service, service_config):
+    if not ('system' in service_config and service_config['system']):
+        return systemd_dir + '/' + service + '.service'
 
-def update_systemctl():
+    # The first of these to have the unit is the one systemd loads
+    for unit_dir in system_unit_dirs:
+        if os.path.exists(unit_dir + '/' + service + '.service'):
+            return unit_dir + '/' + service + '.service'
+    return None
+
+
+def get_unit_hash(unit_path):
+    if unit_path is None or not os.path.exists(unit_path):
+        return None
+    with open(unit_path, 'rb') as unit_stream:
+        return hashlib.sha1(unit_stream.read()).hexdigest()
+
+
+def load_units_manifest():
     try:
-        print('START update systemctl')
-        subprocess.check_call(
-            ['systemctl', '--user', 'daemon-reload'], stderr=subprocess.STDOUT)
-        print('OK update systemctl')
+        with open(units_manifest, 'r') as manifest_stream:
+            return json.load(manifest_stream)
     except:
-        print('ERROR update systemctl')
+        return {}
+
+
+def save_units_manifest(manifest):
+    os.makedirs(os.path.dirname(units_manifest), exist_ok=True)
+    temp_manifest = units_manifest + '.' + str(os.getpid())
+    with open(temp_manifest, 'w') as manifest_stream:
+        json.dump(manifest, manifest_stream)
+    os.replace(temp_manifest, units_manifest)
+
+
+def update_systemctl(config, services):
+    # Only reloads the user and system managers whose units changed since
+    # their last reload, going by the hashes of the unit files
+    manifest = load_units_manifest()
+    changed = {False: [], True: []}
+    hashes = dict()
+
+    for service in services:
+        service_config = config['services'][service]
+        is_system = 'system' in service_config and service_config['system']
+        unit_hash = get_unit_hash(get_unit_path(service, service_config))
+
+        if unit_hash != manifest.get(service):
+            changed[is_system].append(service)
+            hashes[service] = unit_hash
+
+    if len(hashes) == 0:
+        print('No units changed, skipping daemon-reload')
+        return
+
+    for is_system, batch in changed.items():
+        if len(batch) == 0:
+            continue
+
+        subject = 'system' if is_system else None
+        try:
+            report('START', 'update systemctl', subject)
+            subprocess.check_call(
+                get_systemctl_command(is_system, 'daemon-reload'), stderr=subprocess.STDOUT)
+            report('OK', 'update systemctl', subject)
+        except Exception as e:
+            # Leave the old hashes, so the next run tries again
+            report('ERROR', 'update systemctl', subject, e)
+            continue
+
+        # Running services keep their old unit definitions until restarted
+        known = [service for service in batch if manifest.get(service) is not None]
+        if len(known) > 0:
+            result = subprocess.run(get_systemctl_command(is_system, 'is-active') + known,
+                                    stdout=subprocess.PIPE)
+            states = result.stdout.decode().split()
+            for index, service in enumerate(known):
+                if index < len(states) and states[index] in ['active', 'activating', 'reloading']:
+                    report('RESTART', 'needed for changed unit', service)
+
+        for service in batch:
+            if hashes[service] is None:
+                manifest.pop(service, None)
+            else:
+                manifest[service] = hashes[service]
+
+    save_units_manifest(manifest)
 
 
 def execute_systemctl(service_name, service_config, command):
     is_system = 'system' in service_config and service_config['system']
 
-    print('START systemctl ' + command + ' ' + service_name)
+    report('START', 'systemctl ' + command, service_name)
 
     try:
-        if is_system:
-            subprocess.check_call(
-                ['sudo', 'systemctl', command, service_name], stderr=subprocess.STDOUT)
+        subprocess.check_call(
+            get_systemctl_command(is_system, command) + [service_name], stderr=subprocess.STDOUT)
+        report('OK', 'systemctl ' + command, service_name)
+    except Exception as e:
+        report('ERROR', 'systemctl ' + command, service_name, e)
+
+
+def thread_execute_systemctl(service_name, service_config, command):
+    is_system = 'system' in service_config and service_config['system']
+
+    # Buffer the output so that concurrent units don't interleave
+    with output_lock:
+        report('START', 'systemctl ' + command, service_name)
+    result = subprocess.run(get_systemctl_command(is_system, command) + [service_name],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    with output_lock:
+        print(result.stdout.decode(errors='replace'), end='', flush=True)
+        if result.returncode == 0:
+            report('OK', 'systemctl ' + command, service_name)
         else:
-            subprocess.check_call(
-                ['systemctl', '--user', command, service_name], stderr=subprocess.STDOUT)
-        print('OK systemctl ' + command + ' ' + service_name)
-    except:
-        print('ERROR systemctl ' + command + ' ' + service_name)
+            report('ERROR', 'systemctl ' + command, service_name,
+                   subprocess.CalledProcessError(result.returncode, result.args))
 
 
-def restart(config, services):
+def execute_systemctl_batch(config, services, command):
+    user_services = []
+    system_services = []
+
     for service in services:
         service_config = config['services'][service]
-        execute_systemctl(service, service_config, 'restart')
+        if 'system' in service_config and service_config['system']:
+            system_services.append(service)
+        else:
+            user_services.append(service)
+
+    for is_system, batch in [(False, user_services), (True, system_services)]:
+        if len(batch) == 0:
+            continue
+
+        for service in batch:
+            report('START', 'systemctl ' + command, service)
+
+        try:
+            subprocess.check_call(
+                get_systemctl_command(is_system, command) + batch, stderr=subprocess.STDOUT)
+            for service in batch:
+                report('OK', 'systemctl ' + command, service)
+            continue
+        except Exception as e:
+            batch_error = e
+
+        # A failed batch doesn't say which unit failed, so work that out from
+        # each unit's state, rather than bouncing the ones that were fine again
+        result = subprocess.run(get_systemctl_command(is_system, 'is-active') + batch,
+                                stdout=subprocess.PIPE)
+        states = result.stdout.decode().split()
+        wanted = ['inactive', 'failed'] if command == 'stop' else ['active']
+        for index, service in enumerate(batch):
+            if index < len(states) and states[index] in wanted:
+                report('OK', 'systemctl ' + command, service)
+            else:
+                report('ERROR', 'systemctl ' + command, service, batch_error)
+
+
+def execute_systemctl_services(config, services, command):
+    if systemctl_mode == 'batch':
+        execute_systemctl_batch(config, services, command)
+    elif systemctl_mode == 'concurrent':
+        with ThreadPoolExecutor(max_workers=systemctl_parallel) as pool:
+            futures = [(service, pool.submit(thread_execute_systemctl, service,
+                                             config['services'][service], command))
+                       for service in services]
+
+        for service, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                report('ERROR', 'systemctl ' + command, service, e)
+    else:
+        for service in services:
+            execute_systemctl(service, config['services'][service], command)
+
+
+def restart(config, services):
+    execute_systemctl_services(config, services, 'restart')
 
 
 def status(config, services):
+    execute_systemctl_services(config, services, 'status')
+
+
+def get_health_probe(service, service_config):
+    # A service's prereqs.yaml can give a command to probe its health with,
+    # otherwise being active in systemd has to do
+    if not 'source' in service_config:
+        return None
+
+    source_prereq = load_prereqs(root_dir + '/' + service_config['source'])
+    if source_prereq is None or not source_prereq.get('services'):
+        return None
+
+    prereq_service = source_prereq['services'].get(service)
+    if prereq_service is None or not 'health' in prereq_service:
+        return None
+
+    return prereq_service['health']
+
+
+def health(config, services):
     for service in services:
         service_config = config['services'][service]
-        execute_systemctl(service, service_config, 'status')
+        is_system = 'system' in service_config and service_config['system']
+        probe = get_health_probe(service, service_config)
 
+        if probe is not None:
+            command = probe.split()
+            cwd = root_dir + '/' + service_config['source']
+        else:
+            command = get_systemctl_command(is_system, 'is-active') + [service]
+            cwd = None
+
+        # Services can take a while to come up after a restart, so keep
+        # probing until they pass or run out of time
+        report('START', 'health', service)
+        deadline = time.time() + health_timeout
+        while True:
+            result = subprocess.run(command, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, cwd=cwd)
+            if result.returncode == 0:
+                report('OK', 'health', service)
+                break
+
+            if time.time() >= deadline:
+                print(result.stdout.decode(errors='replace'), end='')
+                report('ERROR', 'health', service,
+                       subprocess.CalledProcessError(result.returncode, command))
+                break
+
+            time.sleep(health_interval)
+
+
+def parse_unit_properties(output):
+    # systemctl show prints a block of Name=value lines per unit, in the
+    # order the units were asked for, separated by blank lines
+    units = []
+    for block in output.strip().split('\n\n'):
+        properties = dict()
+        for line in block.splitlines():
+            name, _, value = line.partition('=')
+            properties[name] = value
+        units.append(properties)
+    return units
+
+
+def get_unit_state(properties):
+    state = {'load': properties.get('LoadState'), 'active': properties.get('ActiveState'),
+             'sub': properties.get('SubState'), 'uptime': None, 'memory': None}
+
+    # The timestamp is on the same monotonic clock as ours
+    entered = properties.get('ActiveEnterTimestampMonotonic', '0')
+    if state['active'] == 'active' and entered.isdigit() and int(entered) > 0:
+        state['uptime'] = round(time.monotonic() - int(entered) / 1000000)
+
+    memory = properties.get('MemoryCurrent', '')
+    if memory.isdigit() and int(memory) < 2 ** 64 - 1:
+        state['memory'] = int(memory)
+
+    return state
+
+
+def report_state(service, state):
+    if emit_events:
+        event = {'status': 'STATE', 'step': 'status', 'subject': service}
+        event.update(state)
+        print('EVENT ' + json.dumps(event), flush=True)
+    else:
+        print(service + ' ' + str(state['active']) + ' ' + str(state['sub']) +
+              ' uptime=' + str(state['uptime']) + ' memory=' + str(state['memory']))
+
+
+def report_source(status, source, head_before, head_after):
+    # Tells the controller whether a source moved, for it to aggregate
+    if emit_events:
+        print('EVENT ' + json.dumps({'status': status, 'step': 'update', 'subject': source,
+                                     'old': head_before, 'new': head_after}), flush=True)
+    elif status == 'CHANGED':
+        print('CHANGED ' + source + ' ' + str(head_before) + ' ' + str(head_after))
+    else:
+        print('UNCHANGED ' + source + ' ' + str(head_after))
+
+
+def status_compact(config, services):
+    # One systemctl show per kind of unit, asking only for what the fleet
+    # table needs, rather than a full systemctl status per unit
+    user_services = []
+    system_services = []
 
-def stop(config, services):
     for service in services:
         service_config = config['services'][service]
-        execute_systemctl(service, service_config, 'stop')
+        if 'system' in service_config and service_config['system']:
+            system_services.append(service)
+        else:
+            user_services.append(service)
+
+    for command, batch in [(['systemctl', '--user'], user_services), (['systemctl'], system_services)]:
+        if len(batch) == 0:
+            continue
+
+        try:
+            output = subprocess.check_output(
+                command + ['show', '-p', ','.join(status_properties)] + batch).decode(errors='replace')
+            units = parse_unit_properties(output)
+        except Exception as e:
+            for service in batch:
+                report('ERROR', 'status', service, e)
+            continue
+
+        for index, service in enumerate(batch):
+            if index < len(units):
+                report_state(service, get_unit_state(units[index]))
+            else:
+                report('ERROR', 'status', service)
+
+
+def stop(config, services):
+    execute_systemctl_services(config, services, 'stop')
 
 
 def start(config, services):
-    for service in services:
-        service_config = config['services'][service]
-        execute_systemctl(service, service_config, 'start')
+    execute_systemctl_services(config, services, 'start')
 
 
-def execute_scripts(source_prereqs, services, script_name):
+def get_source_scripts(source_prereq, services, script_name):
     script_key = script_name
     script_root_key = script_name + '_root'
+    script = []
+    script_root = []
 
-    for source, source_prereq in source_prereqs.items():
-        script = []
-        script_root = []
+    if script_key in source_prereq:
+        script.extend(source_prereq[script_key])
+    if script_root_key in source_prereq:
+        script_root.extend(source_prereq[script_root_key])
+    if 'services' in source_prereq:
+        for service_config_name, service_config in source_prereq['services'].items():
+            if service_config_name not in services:
+                continue
 
-        if script_key in source_prereq:
-            script.extend(source_prereq[script_key])
-        if script_root_key in source_prereq:
-            script_root.extend(source_prereq[script_root_key])
-        if 'services' in source_prereq:
-            for service_config_name, service_config in source_prereq['services'].items():
-                if service_config_name not in services:
-                    continue
+            if script_key in service_config:
+                script.extend(service_config[script_key])
+            if script_root_key in service_config:
+                script_root.extend(service_config[script_root_key])
+
+    return script, script_root
+
+
+def get_script_waves(source_prereqs, sources):
+    # A source's prereqs.yaml can list other sources under after, whose
+    # scripts have to finish before its own start
+    remaining = set(sources)
+    waves = []
+
+    while len(remaining) > 0:
+        wave = sorted(source for source in remaining
+                      if not any(after in remaining for after in source_prereqs[source].get('after') or []))
+        if len(wave) == 0:
+            raise Exception('Scripts for ' + ', '.join(sorted(remaining)) + ' are after each other')
+
+        waves.append(wave)
+        remaining.difference_update(wave)
+
+    return waves
+
+
+def execute_buffered(command, target_dir, output):
+    result = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, cwd=target_dir)
+    output.append(result.stdout.decode(errors='replace'))
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, command)
+
+
+def thread_execute_source_scripts(source, script, script_root, script_name):
+    target_dir = root_dir + '/' + source
+    output = []
+    error = None
+
+    with output_lock:
+        report('START', script_name + ' scripts for', source)
 
-                if script_key in service_config:
-                    script.extend(service_config[script_key])
-                if script_root_key in service_config:
-                    script_root.extend(service_config[script_root_key])
+    try:
+        for script_command in script:
+            started = time.time()
+            execute_buffered(script_command.split(), target_dir, output)
+            with output_lock:
+                report_time(script_name + ' script', script_command, started)
+
+        if len(script_root) > 0:
+            # One privileged shell runs them all, rather than a sudo each
+            started = time.time()
+            shell_script = ' && '.join(' '.join(shlex.quote(arg) for arg in script_command.split())
+                                       for script_command in script_root)
+            execute_buffered(['sudo', 'sh', '-c', shell_script], target_dir, output)
+            with output_lock:
+                report_time(script_name + ' root scripts', source, started)
+    except Exception as e:
+        error = e
+
+    # Sources run alongside each other, so hold each one's output back
+    # until it's done rather than interleaving them
+    with output_lock:
+        print(''.join(output), end='', flush=True)
+        if error is None:
+            report('OK', script_name + ' scripts for', source)
+        else:
+            report('ERROR', script_name + ' scripts for', source, error)
+
+
+def execute_scripts(source_prereqs, services, script_name):
+    source_scripts = dict()
 
+    for source, source_prereq in source_prereqs.items():
+        script, script_root = get_source_scripts(source_prereq, services, script_name)
         if len(script) > 0 or len(script_root) > 0:
-            target_dir = root_dir + '/' + source
-            try:
-                print('START ' + script_name + ' scripts for ' + source)
+            source_scripts[source] = (script, script_root)
 
-                for script_command in script:
-                    subprocess.check_call(
-                        script_command.split(), stderr=subprocess.STDOUT, cwd=target_dir)
+    try:
+        waves = get_script_waves(source_prereqs, source_scripts.keys())
+    except Exception as e:
+        report('ERROR', script_name + ' scripts', error=e)
+        return
 
-                for script_command in script_root:
-                    subprocess.check_call(
-                        ['sudo'] + script_command.split(), stderr=subprocess.STDOUT, cwd=target_dir)
+    with ThreadPoolExecutor(max_workers=scripts_parallel) as pool:
+        for wave in waves:
+            futures = [pool.submit(thread_execute_source_scripts, source,
+                                   source_scripts[source][0], source_scripts[source][1], script_name)
+                       for source in wave]
+            for future in futures:
+                future.result()
+
+
+def get_head(target_dir, ref='HEAD'):
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', ref], stderr=subprocess.DEVNULL, cwd=target_dir).decode().strip()
+    except:
+        return None
+
+
+def execute_git(command, target_dir, quiet):
+    started = time.time()
+    if not quiet:
+        subprocess.check_call(command, stderr=subprocess.STDOUT, cwd=target_dir)
+        report_time(' '.join(command[:2]), os.path.basename(target_dir), started)
+        return
+
+    # Only show the output if something went wrong
+    result = subprocess.run(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, cwd=target_dir)
+    report_time(' '.join(command[:2]), os.path.basename(target_dir), started)
+    if result.returncode != 0:
+        print(result.stdout.decode(errors='replace'), end='')
+        raise subprocess.CalledProcessError(result.returncode, command)
+
+
+def get_branch(source_config):
+    if 'branch' in source_config:
+        return source_config['branch']
+    return 'master'
 
-                print('OK ' + script_name + ' scripts for ' + source)
-            except:
-                print('ERROR ' + script_name + ' scripts for ' + source)
 
+def get_source_cache(source_uri):
+    return root_dir + '/.git-cache/' + hashlib.sha1(source_uri.encode()).hexdigest()[:16] + '.git'
 
-def update(config, services, execute_restart):
+
+def fetch_source_cache(source_config, quiet):
+    # Every source on the node shares a bare object cache per upstream, which
+    # is only fetched from once per run however many sources use it
+    source_uri = source_config['source']
+    branch = get_branch(source_config)
+    cache_dir = get_source_cache(source_uri)
+
+    if (source_uri, branch) in fetched_caches:
+        return cache_dir
+
+    if offline:
+        # The controller has already pushed the branch into the cache
+        if not os.path.exists(cache_dir):
+            raise Exception('No pushed copy of ' + source_uri)
+        fetched_caches[(source_uri, branch)] = cache_dir
+        return cache_dir
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+        execute_git(['git', 'init', '-q', '--bare'], cache_dir, quiet)
+
+    execute_git(['git', 'fetch', '-q', '--depth', '1', source_uri,
+                 '+refs/heads/' + branch + ':refs/heads/' + branch], cache_dir, quiet)
+
+    fetched_caches[(source_uri, branch)] = cache_dir
+    return cache_dir
+
+
+def checkout_source(source_config, target_dir, clean, quiet):
+    # Reuses an existing checkout if there is one, otherwise starts a fresh one
+    cache_dir = fetch_source_cache(source_config, quiet)
+    branch = get_branch(source_config)
+
+    if not os.path.exists(target_dir + '/.git'):
+        os.makedirs(target_dir, exist_ok=True)
+        execute_git(['git', 'init', '-q'], target_dir, quiet)
+
+    execute_git(['git', 'fetch', '-q', '--depth', '1', cache_dir,
+                 'refs/heads/' + branch], target_dir, quiet)
+    execute_git(['git', 'checkout', '-q', '-f', '-B', branch, 'FETCH_HEAD'], target_dir, quiet)
+
+    if clean:
+        execute_git(['git', 'clean', '-q', '-ffdx'], target_dir, quiet)
+
+
+def update(config, services, execute_restart, force, only_changed):
     sources = set()
+    changed_sources = set()
     source_prereqs = dict()
 
     for service in services:
@@ -106,50 +712,147 @@ def update(config, services, execute_restart):
         is_system = 'system' in service_config and service_config['system']
 
         if is_system:
-            print('Not updating ' + service + ' as it is system')
+            if not only_changed:
+                print('Not updating ' + service + ' as it is system')
             continue
 
         if not 'source' in service_config:
-            print('ERROR Service ' + service + ' missing source')
+            report('ERROR', 'Service missing source', service)
             continue
 
         sources.add(config['services'][service]['source'])
 
     for source in sources:
+        source_config = config['sources'][source]
+        target_dir = root_dir + '/' + source
+        head_before = get_head(target_dir)
+        head_after = head_before
+
         try:
-            print('START Updating ' + source)
+            if not only_changed:
+                report('START', 'Updating', source)
+
+            # Only a new commit gets a new release, the live one is left be
+            cache_dir = fetch_source_cache(source_config, only_changed)
+            if get_head(cache_dir, 'refs/heads/' + get_branch(source_config)) != head_before:
+                release_dir = checkout_release(source, source_config, 'update', only_changed)
+                switch_release(target_dir, release_dir)
+                prune_releases(root_dir + '/releases/' + source, keep_releases, target_dir)
+                head_after = get_head(target_dir)
+
+            if not only_changed:
+                report('OK', 'Updating', source)
+        except Exception as e:
+            report('ERROR', 'Updating', source, e)
+            continue
 
-            source_config = config['sources'][source]
-            target_dir = root_dir + '/' + source
-            branch = 'master'
-            if 'branch' in source_config:
-                branch = source_config['branch']
+        if head_before != head_after:
+            report_source('CHANGED', source, head_before, head_after)
+        elif not only_changed:
+            report_source('UNCHANGED', source, head_before, head_after)
 
-            subprocess.check_call(
-                ['git', 'reset', '--hard'], stderr=subprocess.STDOUT, cwd=target_dir)
-            subprocess.check_call(
-                ['git', 'checkout', branch], stderr=subprocess.STDOUT, cwd=target_dir)
-            subprocess.check_call(
-                ['git', 'pull'], stderr=subprocess.STDOUT, cwd=target_dir)
+        # Forcing runs the update scripts and restarts for unmoved sources too
+        if head_before == head_after and not force:
+            continue
 
-            print('OK Updating ' + source)
-        except:
-            print('ERROR Updating ' + source)
+        changed_sources.add(source)
 
-        source_config_file = target_dir + '/prereqs.yaml'
-        if os.path.exists(source_config_file):
-            source_config_stream = open(source_config_file, 'r')
-            source_prereqs[source] = yaml.safe_load(source_config_stream)
+        source_prereq = load_prereqs(target_dir)
+        if source_prereq is not None:
+            source_prereqs[source] = source_prereq
+
+    if len(changed_sources) == 0:
+        if not only_changed:
+            print('Nothing changed, skipping update scripts')
+        return
 
     execute_scripts(source_prereqs, services, 'update')
-    update_systemctl()
+    update_systemctl(config, services)
 
     if execute_restart:
-        restart(config, services)
+        changed_services = set()
+        for source in changed_sources:
+            changed_services.update(config['_index']['source_services'].get(source, []))
+        restart(config, [service for service in services if service in changed_services])
+
+
+def get_release_name(kind):
+    # Down to the microsecond, as one run may make several releases of a source,
+    # and in UTC so the names keep sorting by age across daylight saving changes
+    now = time.time()
+    return kind + '-' + time.strftime('%Y%m%d%H%M%S', time.gmtime(now)) + \
+        '%06d' % int(now % 1 * 1000000) + '-' + str(os.getpid())
+
+
+def get_release_age(release_dir):
+    # Release names are <kind>-<timestamp>-<pid>
+    return os.path.basename(release_dir).split('-', 1)[-1]
+
+
+def get_releases(releases_dir):
+    if not os.path.isdir(releases_dir):
+        return []
+    releases = [releases_dir + '/' + name for name in os.listdir(releases_dir)]
+    releases.sort(key=get_release_age, reverse=True)
+    return releases
+
+
+def get_current_release(target_dir):
+    if os.path.islink(target_dir):
+        return os.path.realpath(target_dir)
+    return None
+
+
+def prune_releases(releases_dir, keep, target_dir):
+    # The live release is always kept, even after rolling back past the
+    # newest ones
+    current = get_current_release(target_dir)
+    for release_dir in get_releases(releases_dir)[keep:]:
+        if os.path.realpath(release_dir) == current:
+            continue
+        subprocess.check_call(['rm', '-rf', release_dir],
+                              stderr=subprocess.STDOUT)
+
+
+def checkout_release(source, source_config, kind, quiet):
+    # Checks the source out into a new release, without touching the live
+    # one. Updates start from a copy of the live release so that anything
+    # its setup scripts built is carried over, installs start afresh.
+    target_dir = root_dir + '/' + source
+    releases_dir = root_dir + '/releases/' + source
+    release_dir = releases_dir + '/' + get_release_name(kind)
+    os.makedirs(releases_dir, exist_ok=True)
+
+    try:
+        if kind == 'update' and os.path.isdir(target_dir):
+            subprocess.check_call(['cp', '-a', os.path.realpath(target_dir), release_dir],
+                                  stderr=subprocess.STDOUT)
+        checkout_source(source_config, release_dir, kind == 'install', quiet)
+    except:
+        subprocess.call(['rm', '-rf', release_dir], stderr=subprocess.STDOUT)
+        raise
+
+    return release_dir
+
+
+def switch_release(target_dir, release_dir):
+    # Swap the live path over with a rename, so it's never missing or half
+    # written. A plain checkout from before releases existed is kept aside
+    # as a release of its own, dated before every other release as it
+    # predates them all.
+    if os.path.isdir(target_dir) and not os.path.islink(target_dir):
+        os.rename(target_dir, os.path.dirname(release_dir) +
+                  '/checkout-' + '0' * 20 + '-' + str(os.getpid()))
+
+    temp_link = target_dir + '.new'
+    if os.path.lexists(temp_link):
+        os.remove(temp_link)
+    os.symlink(release_dir, temp_link)
+    os.replace(temp_link, target_dir)
 
 
 def sideload(config, services, execute_restart):
-    sideload_services = set()
+    sources = set()
     source_prereqs = dict()
 
     for service in services:
@@ -160,39 +863,196 @@ def sideload(config, services, execute_restart):
             print('Not sideloading ' + service + ' as it is system')
             continue
 
-        sideload_services.add(service)
+        if not 'source' in service_config:
+            report('ERROR', 'Service missing source', service)
+            continue
+
+        sources.add(service_config['source'])
+
+    for source in sources:
+        target_dir = root_dir + '/' + source
 
-    for source in sideload_services:
         try:
-            print('START Sideloading ' + source)
+            report('START', 'Sideloading', source)
 
-            target_dir = root_dir + '/' + config['services'][service]['source']
-            source_dir = root_dir + '/sideload-' + source
+            sideload_dir = root_dir + '/sideload/' + source
+            releases_dir = root_dir + '/releases/' + source
+            release_dir = releases_dir + '/' + get_release_name('sideload')
 
-            subprocess.check_call(
-                ['rm', '-rf', target_dir], stderr=subprocess.STDOUT, cwd=root_dir)
+            os.makedirs(releases_dir, exist_ok=True)
 
+            # The sideload dir is kept for the next rsync, so take a hard
+            # linked copy of it; rsync replaces files rather than editing them
             subprocess.check_call(
-                ['mv', source_dir, target_dir], stderr=subprocess.STDOUT, cwd=root_dir)
+                ['cp', '-al', sideload_dir, release_dir], stderr=subprocess.STDOUT)
+            switch_release(target_dir, release_dir)
+            prune_releases(releases_dir, keep_releases, target_dir)
 
-            print('OK Sideloading ' + source)
+            report('OK', 'Sideloading', source)
         except Exception as e:
-            print(e)
-            print('ERROR Sideloading ' + source)
+            report('ERROR', 'Sideloading', source, e)
+            continue
 
-        source_config_file = target_dir + '/prereqs.yaml'
-        if os.path.exists(source_config_file):
-            source_config_stream = open(source_config_file, 'r')
-            source_prereqs[source] = yaml.safe_load(source_config_stream)
+        source_prereq = load_prereqs(target_dir)
+        if source_prereq is not None:
+            source_prereqs[source] = source_prereq
 
     execute_scripts(source_prereqs, services, 'update')
-    update_systemctl()
+    update_systemctl(config, services)
 
     if execute_restart:
         restart(config, services)
 
 
-def install(config, services, execute_prereqs):
+def rollback(config, services):
+    # Switches each source back to the release before the live one, which
+    # is already on disk, so nothing is fetched
+    sources = set()
+    rolled_back = set()
+
+    for service in services:
+        service_config = config['services'][service]
+        is_system = 'system' in service_config and service_config['system']
+
+        if is_system:
+            print('Not rolling back ' + service + ' as it is system')
+            continue
+
+        if not 'source' in service_config:
+            report('ERROR', 'Service missing source', service)
+            continue
+
+        sources.add(service_config['source'])
+
+    for source in sources:
+        target_dir = root_dir + '/' + source
+
+        try:
+            report('START', 'Rolling back', source)
+
+            current = get_current_release(target_dir)
+            releases = [os.path.realpath(release_dir)
+                        for release_dir in get_releases(root_dir + '/releases/' + source)]
+            if current not in releases:
+                raise Exception('No release is live to roll back from')
+
+            index = releases.index(current)
+            if index + 1 >= len(releases):
+                raise Exception('No earlier release to roll back to')
+
+            switch_release(target_dir, releases[index + 1])
+            print('ROLLBACK ' + source + ' ' + os.path.basename(current) +
+                  ' ' + os.path.basename(releases[index + 1]))
+            rolled_back.add(source)
+
+            report('OK', 'Rolling back', source)
+        except Exception as e:
+            report('ERROR', 'Rolling back', source, e)
+
+    if len(rolled_back) == 0:
+        return
+
+    update_systemctl(config, services)
+    restart(config, [service for service in services
+                     if config['services'][service].get('source') in rolled_back and
+                     not config['services'][service].get('system')])
+
+
+def load_prereqs_manifest(refresh):
+    if refresh or not os.path.exists(prereqs_manifest):
+        return {'apt': [], 'pip': []}
+
+    try:
+        with open(prereqs_manifest, 'r') as manifest_stream:
+            return json.load(manifest_stream)
+    except:
+        return {'apt': [], 'pip': []}
+
+
+def save_prereqs_manifest(manifest):
+    os.makedirs(os.path.dirname(prereqs_manifest), exist_ok=True)
+    temp_manifest = prereqs_manifest + '.' + str(os.getpid())
+    with open(temp_manifest, 'w') as manifest_stream:
+        json.dump(manifest, manifest_stream)
+    os.replace(temp_manifest, prereqs_manifest)
+
+
+def get_installed_apt(packages):
+    result = subprocess.run(['dpkg-query', '-W', '-f=${Package} ${Status}\\n'] + sorted(packages),
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    installed = set()
+
+    for line in result.stdout.decode().splitlines():
+        parts = line.split(' ', 1)
+        if len(parts) == 2 and parts[1] == 'install ok installed':
+            installed.add(parts[0])
+
+    return set(package for package in packages if package.split(':')[0] in installed)
+
+
+def normalise_pip_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def get_installed_pip(packages):
+    versions = dict()
+    for distribution in metadata.distributions():
+        name = distribution.metadata['Name']
+        if name is not None:
+            versions[normalise_pip_name(name)] = distribution.version
+
+    installed = set()
+
+    for package in packages:
+        # Only plain names and exact pins can be checked without pip itself
+        match = re.match(r'^([A-Za-z0-9._-]+)\s*(?:==\s*([A-Za-z0-9._+!-]+))?$', package)
+        if match is None:
+            continue
+
+        name = normalise_pip_name(match.group(1))
+        if name in versions and (match.group(2) is None or match.group(2) == versions[name]):
+            installed.add(package)
+
+    return installed
+
+
+def install_packages(apt, pip, refresh, use_wheels):
+    # The manifest remembers what has already been satisfied, so a repeat
+    # install only has to look at packages it hasn't seen before
+    manifest = load_prereqs_manifest(refresh)
+
+    tools = [
+        ('apt', apt, get_installed_apt,
+         ['sudo', 'apt-get', 'install', '-y']),
+        ('pip', pip, get_installed_pip,
+         ['pip', 'install'] + (['--find-links', wheels_dir] if use_wheels else []))
+    ]
+
+    for tool, packages, get_installed, command in tools:
+        unknown = set(packages).difference(manifest[tool])
+        if len(unknown) == 0:
+            continue
+
+        satisfied = get_installed(unknown)
+        missing = unknown.difference(satisfied)
+        manifest[tool] = sorted(set(manifest[tool]).union(satisfied))
+
+        if len(missing) == 0:
+            continue
+
+        names = ', '.join(sorted(missing))
+        try:
+            report('START', tool + ' package install', names)
+            subprocess.check_call(command + sorted(missing), stderr=subprocess.STDOUT)
+            manifest[tool] = sorted(set(manifest[tool]).union(missing))
+            report('OK', tool + ' package install', names)
+        except Exception as e:
+            report('ERROR', tool + ' package install', names, e)
+
+    save_prereqs_manifest(manifest)
+
+
+def install(config, services, execute_prereqs, refresh_prereqs, use_wheels):
     sources = set()
     source_prereqs = dict()
     apt = set()
@@ -210,39 +1070,30 @@ def install(config, services, execute_prereqs):
             continue
 
         if not 'source' in service_config:
-            print('ERROR Service ' + service + ' missing source')
+            report('ERROR', 'Service missing source', service)
             continue
 
         sources.add(config['services'][service]['source'])
 
     for source in sources:
+        target_dir = root_dir + '/' + source
+
         try:
-            print('START Installing ' + source)
+            report('START', 'Installing', source)
 
             source_config = config['sources'][source]
-            target_dir = root_dir + '/' + source
-            source_uri = source_config['source']
-            branch = 'master'
-            if 'branch' in source_config:
-                branch = source_config['branch']
+            release_dir = checkout_release(source, source_config, 'install', False)
+            switch_release(target_dir, release_dir)
+            prune_releases(root_dir + '/releases/' + source, keep_releases, target_dir)
 
-            subprocess.check_call(
-                ['rm', '-rf', target_dir], stderr=subprocess.STDOUT)
-            subprocess.check_call(
-                ['mkdir', '-p', target_dir], stderr=subprocess.STDOUT)
-            subprocess.check_call(
-                ['git', 'clone', source_uri, '.'], stderr=subprocess.STDOUT, cwd=target_dir)
-            subprocess.check_call(
-                ['git', 'checkout', branch], stderr=subprocess.STDOUT, cwd=target_dir)
-
-            print('OK Installing ' + source)
-        except:
-            print('ERROR Installing ' + source)
+            report('OK', 'Installing', source)
+        except Exception as e:
+            report('ERROR', 'Installing', source, e)
+            continue
 
-        source_config_file = target_dir + '/prereqs.yaml'
-        if os.path.exists(source_config_file):
-            source_config_stream = open(source_config_file, 'r')
-            source_prereqs[source] = yaml.safe_load(source_config_stream)
+        source_prereq = load_prereqs(target_dir)
+        if source_prereq is not None:
+            source_prereqs[source] = source_prereq
 
     for service in services:
         service_config = config['services'][service]
@@ -252,16 +1103,17 @@ def install(config, services, execute_prereqs):
             continue
 
         try:
-            print('START Symlink ' + service)
+            report('START', 'Symlink', service)
             target_dir = root_dir + '/' + service_config['source']
-            symlink_target = '/home/pi/.config/systemd/user/' + service + '.service'
+            symlink_target = systemd_dir + '/' + service + '.service'
+            os.makedirs(systemd_dir, exist_ok=True)
             subprocess.check_call(
                 ['rm', '-f', symlink_target], stderr=subprocess.STDOUT)
             subprocess.check_call(
                 ['ln', '-s', target_dir + '/' + service + '.service', symlink_target], stderr=subprocess.STDOUT)
-            print('OK Symlink ' + service)
-        except:
-            print('ERROR Symlink ' + service)
+            report('OK', 'Symlink', service)
+        except Exception as e:
+            report('ERROR', 'Symlink', service, e)
 
     for _, source_prereq in source_prereqs.items():
         if 'apt' in source_prereq:
@@ -281,30 +1133,15 @@ def install(config, services, execute_prereqs):
                 if 'pip' in service_config:
                     pip.update(service_config['pip'])
 
-    if execute_prereqs and len(apt) > 0:
-        try:
-            print('START apt package install: ' + ', '.join(apt))
-            subprocess.check_call(
-                ['sudo', 'apt-get', 'install'] + list(apt), stderr=subprocess.STDOUT)
-            print('OK apt package install')
-        except:
-            print('ERROR apt package install')
-
-    if execute_prereqs and len(pip) > 0:
-        try:
-            print('START pip package install: ' + ', '.join(pip))
-            subprocess.check_call(['pip', 'install'] + list(pip),
-                                  stderr=subprocess.STDOUT)
-            print('OK pip package install')
-        except:
-            print('ERROR pip package install')
+    if execute_prereqs:
+        install_packages(apt, pip, refresh_prereqs, use_wheels)
 
     execute_scripts(source_prereqs, services, 'setup')
-    update_systemctl()
+    update_systemctl(config, services)
 
 
 def install_prereqs():
-    print('START install deps')
+    report('START', 'install deps')
     try:
         subprocess.check_call(
             ['sudo', 'apt-get', 'install', 'python3', 'git', 'python3-pip', '-y'], stderr=subprocess.STDOUT)
@@ -312,9 +1149,9 @@ def install_prereqs():
             ['sudo', 'update-alternatives', '--set', 'python', '/usr/bin/python3'], stderr=subprocess.STDOUT)
         subprocess.check_call(
             ['pip', 'install', 'pyyaml'], stderr=subprocess.STDOUT)
-        print('OK install deps')
-    except:
-        print('ERROR install deps')
+        report('OK', 'install deps')
+    except Exception as e:
+        report('ERROR', 'install deps', error=e)
 
 
 def execute_shutdown():
@@ -322,8 +1159,12 @@ def execute_shutdown():
                           stderr=subprocess.STDOUT)
 
 
-if __name__ == '__main__':
+def get_parser():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default=None,
+                        help='Directory to keep checkouts and caches in, instead of ' + root_dir)
+    parser.add_argument('--systemd-dir', default=None,
+                        help='Directory to link systemd user units into, instead of ' + systemd_dir)
     parser.add_argument('config', help='Path to config YAML file')
     parser.add_argument('operation', help='Operation to execute')
     parser.add_argument('services', nargs='*',
@@ -332,11 +1173,76 @@ if __name__ == '__main__':
                         help='Update, Sideload: Also restart the systemctl service after the operation')
     parser.add_argument('-p', '--no-prereqs', action='store_false',
                         help='Install: Don\'t install the prerequisites')
-    args = parser.parse_args()
-
-    print('Parsing configuration file "' + args.config + '"')
-    config_stream = open(args.config, 'r')
-    config = yaml.safe_load(config_stream)
+    parser.add_argument('--refresh-prereqs', action='store_true',
+                        help='Install: Check every prerequisite again, rather than trusting the ones already recorded as installed')
+    parser.add_argument('--wheels', action='store_true',
+                        help='Install: Let pip use the wheels shipped by the controller')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Update: Run the update scripts and restart even for sources that haven\'t changed')
+    parser.add_argument('--only-changed', action='store_true',
+                        help='Update: Only report on sources that changed')
+    parser.add_argument('--offline', action='store_true',
+                        help='Install, Update: Use the sources pushed by the controller rather than fetching them')
+    parser.add_argument('--systemctl-mode', choices=systemctl_modes, default=None,
+                        help='Start, Stop, Restart, Status: Run systemctl once per batch of units, concurrently per unit, or serially per unit')
+    parser.add_argument('--compact', action='store_true',
+                        help='Status: Report each unit\'s state, uptime and memory from one systemctl show')
+    parser.add_argument('--events', action='store_true',
+                        help='Report steps as EVENT lines of JSON, for the controller to aggregate')
+    return parser
+
+
+def apply_layout(args):
+    # Everything kept on the node hangs off the root, so that several
+    # configs can be deployed side by side under different ones
+    global root_dir
+    global systemd_dir
+    global prereqs_manifest
+    global wheels_dir
+    global config_cache_dir
+    global units_manifest
+
+    if args.root is not None:
+        root_dir = args.root.rstrip('/')
+        prereqs_manifest = root_dir + '/.cache/prereqs.json'
+        wheels_dir = root_dir + '/wheels'
+        config_cache_dir = root_dir + '/.cache/configs'
+        units_manifest = root_dir + '/.cache/units.json'
+
+    if args.systemd_dir is not None:
+        systemd_dir = args.systemd_dir.rstrip('/')
+
+
+def apply_options(config, args):
+    global offline
+    global systemctl_mode
+    global emit_events
+    global health_timeout
+    global scripts_parallel
+    global keep_releases
+
+    offline = args.offline
+    emit_events = args.events
+
+    settings = config['settings'] if 'settings' in config and config['settings'] else {}
+    if args.systemctl_mode is not None:
+        systemctl_mode = args.systemctl_mode
+    elif 'systemctl_mode' in settings:
+        systemctl_mode = settings['systemctl_mode']
+    else:
+        systemctl_mode = 'batch'
+
+    health_timeout = float(settings['health_timeout']) if 'health_timeout' in settings else default_health_timeout
+    scripts_parallel = max(1, int(settings['scripts_parallel'])) \
+        if 'scripts_parallel' in settings else default_scripts_parallel
+    keep_releases = max(1, int(settings['keep_releases'])) \
+        if 'keep_releases' in settings else default_keep_releases
+
+
+def execute_operation(config, args):
+    global daemon_running
+
+    apply_options(config, args)
 
     if args.operation == 'start':
         start(config, args.services)
@@ -345,20 +1251,151 @@ if __name__ == '__main__':
     elif args.operation == 'restart':
         restart(config, args.services)
     elif args.operation == 'status':
-        status(config, args.services)
+        if args.compact:
+            status_compact(config, args.services)
+        else:
+            status(config, args.services)
     elif args.operation == 'update':
-        update(config, args.services, args.restart)
+        update(config, args.services, args.restart,
+               args.force, args.only_changed)
     elif args.operation == 'sideload':
         sideload(config, args.services, args.restart)
+    elif args.operation == 'rollback':
+        rollback(config, args.services)
     elif args.operation == 'install':
-        install(config, args.services, args.no_prereqs)
+        install(config, args.services, args.no_prereqs,
+                args.refresh_prereqs, args.wheels)
     elif args.operation == 'install-prereqs':
         install_prereqs()
     elif args.operation == 'shutdown':
-        os.remove(args.config)
         execute_shutdown()
+    elif args.operation == 'health':
+        health(config, args.services)
     elif args.operation == 'ping':
         print('Pong')
+    elif args.operation == 'daemon-stop':
+        daemon_running = False
+        print('Stopping daemon')
+    else:
+        raise Exception('Unknown operation ' + args.operation)
+
+
+def execute_requests(requests, parser, config_path):
+    # Reads one JSON request per line, {"operation": ..., "services": [...],
+    # "args": [...], "config": ...}, runs them in order in this one process,
+    # and follows each one's output with a RESULT line
+    all_ok = True
+
+    for line in requests:
+        if len(line.strip()) == 0:
+            continue
+
+        started = time.time()
+        failed_before = failed_steps
+        result = {'operation': None, 'ok': True}
+
+        try:
+            request = json.loads(line)
+            result['operation'] = request['operation']
+            request_config = request.get('config', config_path)
+            step_args = parser.parse_args(
+                [request_config, request['operation']] + request.get('services', []) + request.get('args', []))
+            execute_operation(load_config(request_config), step_args)
+        except SystemExit:
+            result['ok'] = False
+            result['error'] = 'Invalid arguments'
+        except Exception as e:
+            print(e)
+            result['ok'] = False
+            result['error'] = str(e)
+
+        if failed_steps > failed_before:
+            result['ok'] = False
+
+        result['duration'] = round(time.time() - started, 3)
+        print('RESULT ' + json.dumps(result), flush=True)
+        all_ok = all_ok and result['ok']
+
+    return all_ok
+
+
+def get_daemon_socket():
+    # Named after this script, which is named by its hash, so a daemon is
+    # never reached by a controller expecting a different version
+    return root_dir + '/run/' + os.path.basename(__file__)[:-len('.py')] + '.sock'
 
-    if os.path.exists(args.config):
-        os.remove(args.config)
+
+def daemon(parser, config_path):
+    global daemon_running
+
+    socket_path = get_daemon_socket()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    if os.path.lexists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    server.listen(8)
+    print('Listening on ' + socket_path)
+
+    daemon_running = True
+    while daemon_running:
+        client, _ = server.accept()
+        stdout_fd = os.dup(1)
+        stderr_fd = os.dup(2)
+        error = None
+
+        try:
+            # Point our stdout and stderr at the client while serving it, so
+            # that it also gets the output of every command we run
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(client.fileno(), 1)
+            os.dup2(client.fileno(), 2)
+            # Each client is a run of its own, which fetches afresh
+            fetched_caches.clear()
+            execute_requests(client.makefile('r'), parser, config_path)
+        except Exception as e:
+            # Most likely the client went away, so report it locally instead
+            error = e
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except:
+                pass
+            os.dup2(stdout_fd, 1)
+            os.dup2(stderr_fd, 2)
+            os.close(stdout_fd)
+            os.close(stderr_fd)
+            client.close()
+
+        if error is not None:
+            print(error)
+
+    server.close()
+    os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    # Keep our own output in order with that of the commands we run
+    sys.stdout.reconfigure(line_buffering=True)
+
+    parser = get_parser()
+    args = parser.parse_args()
+    apply_layout(args)
+
+    print('Parsing configuration file "' + args.config + '"')
+    config = load_config(args.config)
+
+    if args.operation == 'agent':
+        if not execute_requests(sys.stdin, parser, args.config):
+            sys.exit(1)
+    elif args.operation == 'daemon':
+        daemon(parser, args.config)
+    else:
+        execute_operation(config, args)
+
+    if failed_steps > 0:
+        sys.exit(1)
@@ -2,15 +2,955 @@ import subprocess
 import threading
 import argparse
 import yaml
-import random
+import os
+import hashlib
+import shlex
+import json
+import socket
+import sys
+import time
+import queue
+import re
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+default_user = 'pi'
+host_layouts = dict()
+host_connections = dict()
+local_git_cache = os.path.expanduser('~/.zoidberg/sources')
+target_script = None
+remote_args = []
+cache_max_age_days = 30
+control_dir = os.path.expanduser('~/.zoidberg/control')
+control_persist = 'yes'
+default_connect_timeout = 10
+connect_timeout = default_connect_timeout
+opened_connections = dict()
+opened_connections_lock = threading.Lock()
+default_parallel = 10
+chainable_operations = ['start', 'run', 'stop',
+                        'restart', 'status', 'update', 'install', 'ping', 'health', 'rollback']
+executor = None
+deploy_uploads = dict()
+deploy_uploads_lock = threading.Lock()
+json_output = False
+events = []
+events_lock = threading.Lock()
+step_starts = dict()
+profile_dir = os.path.expanduser('~/.zoidberg/profiles')
+default_profile_history = 100
+status_cache_dir = os.path.expanduser('~/.zoidberg/status')
+default_status_ttl = 5
+default_watch_debounce = 0.2
+rolling_pattern = r'^[1-9][0-9]*%?$'
+watch_poll_interval = 0.5
+config_cache_dir = os.path.expanduser('~/.zoidberg/configs')
+run_dir = os.path.expanduser('~/.zoidberg/runs')
+default_run_history = 50
+journal = None
+journal_lock = threading.Lock()
+journal_saved = 0
+journal_save_interval = 1
+plan_progress = dict()
+default_retries = 2
+default_retry_backoff = 1
+retries = default_retries
+retry_backoff = default_retry_backoff
+config_cache_version = 3
+known_operations = ['install', 'update', 'rollback', 'start', 'run', 'stop', 'restart', 'status',
+                    'health', 'sideload', 'watch', 'install-prereqs', 'shutdown', 'ping',
+                    'daemon-start', 'daemon-stop', 'plan']
+setting_types = {'parallel': int, 'systemctl_mode': str, 'use_daemon': bool, 'rolling': (int, str),
+                 'push_sources': bool, 'profile_history': int, 'status_ttl': (int, float),
+                 'watch_debounce': (int, float), 'health_timeout': (int, float),
+                 'scripts_parallel': int, 'root': str, 'systemd_dir': str, 'keep_releases': int,
+                 'retries': int, 'retry_backoff': (int, float), 'run_history': int,
+                 'connect_timeout': int}
+
+
+def log(message):
+    '''Prints a message, wrapped up as JSON when the output is JSON lines'''
+    if json_output:
+        print(json.dumps({'type': 'log', 'message': message}), flush=True)
+    else:
+        print(message, flush=True)
+
+
+def record_event(event):
+    '''Records a step event for the summary and the journal, and prints it'''
+    journal_event(event)
+
+    with events_lock:
+        events.append(event)
+
+        if json_output:
+            print(json.dumps(dict(event, type='event')), flush=True)
+            return
+
+        # Phase timings are only wanted for the profile, and unit states
+        # for the status table
+        if event['status'] in ['TIME', 'STATE']:
+            return
+
+        prefix = ''
+        line = event['status'] + ' ' + event['step']
+        if event.get('subject') is not None:
+            line += ' ' + event['subject']
+        if event['status'] == 'CHANGED':
+            line += ' ' + str(event.get('old')) + ' ' + str(event.get('new'))
+
+        if event['origin'] == 'node':
+            prefix = '[' + event['host'] + '] '
+        elif event['host'] is not None:
+            line += ' ' + event['host']
+
+        if event.get('error') is not None:
+            print(prefix + event['error'])
+        print(prefix + line, flush=True)
+
+
+def report(status, step, host=None, error=None):
+    '''Reports a step run by the controller, timing it from its START'''
+    now = time.time()
+    key = (step, host)
+    event = {'status': status, 'step': step, 'host': host,
+             'origin': 'controller', 'time': round(now, 3)}
+
+    with events_lock:
+        if status == 'START':
+            step_starts[key] = now
+        elif key in step_starts:
+            event['duration'] = round(now - step_starts.pop(key), 3)
+
+    if isinstance(error, subprocess.CalledProcessError):
+        event['exit_code'] = error.returncode
+    if error is not None:
+        event['error'] = str(error)
+
+    record_event(event)
+
+
+def report_time(step, host, started):
+    '''Records how long a phase of a step took on the controller, for the profile'''
+    now = time.time()
+    record_event({'status': 'TIME', 'step': step, 'host': host, 'origin': 'controller',
+                  'time': round(now, 3), 'duration': round(now - started, 3)})
+
+
+def handle_remote_line(host, line):
+    '''Handles a line of output from zoidberg deploy on a host, recording
+    the events it reports and tagging everything else with the host'''
+    if line.startswith('RESULT '):
+        try:
+            journal_result(host, json.loads(line[len('RESULT '):]))
+            return
+        except ValueError:
+            pass
+
+    if line.startswith('EVENT '):
+        try:
+            event = json.loads(line[len('EVENT '):])
+            event['host'] = host
+            event['origin'] = 'node'
+            # Node clocks can't be trusted to agree with ours
+            event['time'] = round(time.time(), 3)
+            record_event(event)
+            return
+        except ValueError:
+            pass
+
+    if json_output:
+        print(json.dumps({'type': 'output', 'host': host, 'line': line}), flush=True)
+    else:
+        print('[' + host + '] ' + line, flush=True)
+
+
+def get_pending_restarts():
+    '''Gets the (host, service) pairs whose units changed while they were
+    running, and which haven't been restarted, started or stopped since'''
+    pending = []
+
+    for event in events:
+        key = (event['host'], event.get('subject'))
+        if event['status'] == 'RESTART' and key not in pending:
+            pending.append(key)
+        elif event['status'] == 'OK' and key in pending and \
+                event['step'] in ['systemctl restart', 'systemctl start', 'systemctl stop']:
+            pending.remove(key)
+
+    return pending
+
+
+def get_changed_sources():
+    '''Gets the sources that moved to a new commit on each host, in the order they moved'''
+    return [{'host': event['host'], 'source': event['subject'], 'old': event.get('old'),
+             'new': event.get('new')} for event in events if event['status'] == 'CHANGED']
+
+
+def summarise():
+    '''Prints a per host summary of the run, returning whether everything succeeded'''
+    hosts = dict()
+    failures = []
+    restarts = get_pending_restarts()
+    changed = get_changed_sources()
+
+    for event in events:
+        if event['status'] not in ['OK', 'ERROR']:
+            continue
+
+        host = event['host'] if event['host'] is not None else '-'
+        summary = hosts.setdefault(host, {'steps': 0, 'failed': 0, 'duration': 0.0})
+        summary['steps'] += 1
+        if event['origin'] == 'controller':
+            summary['duration'] += event.get('duration', 0.0)
+
+        if event['status'] == 'ERROR':
+            summary['failed'] += 1
+            failures.append(event)
+
+    if json_output:
+        print(json.dumps({'type': 'summary', 'ok': len(failures) == 0, 'hosts': hosts,
+                          'failures': failures, 'changed': changed,
+                          'restarts': [{'host': host, 'service': service}
+                                       for host, service in restarts]}), flush=True)
+        return len(failures) == 0
+
+    width = max([len('host')] + [len(host) for host in hosts])
+    print('')
+    print('host'.ljust(width) + '  steps  failed  seconds')
+    for host in sorted(hosts):
+        summary = hosts[host]
+        print(host.ljust(width) + '  ' + str(summary['steps']).rjust(5) + '  ' +
+              str(summary['failed']).rjust(6) + '  ' + ('%.2f' % summary['duration']).rjust(7))
+
+    for event in failures:
+        line = 'FAILED ' + (event['host'] or '-') + ' ' + event['step']
+        if event.get('subject') is not None:
+            line += ' ' + event['subject']
+        if 'exit_code' in event:
+            line += ' (exit code ' + str(event['exit_code']) + ')'
+        print(line)
+
+    for source in changed:
+        print('CHANGED ' + source['host'] + ' ' + source['source'] + ' ' +
+              str(source['old']) + ' ' + str(source['new']))
+
+    for host, service in restarts:
+        print('RESTART NEEDED ' + host + ' ' + service)
+
+    return len(failures) == 0
+
+
+def get_phase_name(event):
+    '''Gets the name a timed event is grouped under in a profile'''
+    return event['origin'] + ': ' + event['step']
+
+
+def build_profile(config_path, operation, started, ok):
+    '''Merges the timings of every host into one profile of the run
+
+    Each host's wall time runs from its first to its last controller event,
+    and the slowest host is the critical path of the run.'''
+    profile = {'config': os.path.abspath(config_path), 'operation': operation,
+               'started': round(started, 3), 'wall': round(time.time() - started, 3),
+               'ok': ok, 'hosts': dict(), 'phases': dict(), 'critical_path': None}
+
+    for event in events:
+        if 'duration' not in event:
+            continue
+
+        phase = get_phase_name(event)
+        totals = profile['phases'].setdefault(phase, {'count': 0, 'total': 0.0, 'max': 0.0})
+        totals['count'] += 1
+        totals['total'] = round(totals['total'] + event['duration'], 3)
+        totals['max'] = max(totals['max'], event['duration'])
+
+        if event['host'] is None:
+            continue
+
+        host = profile['hosts'].setdefault(
+            event['host'], {'first': None, 'last': None, 'phases': []})
+        host['phases'].append([phase, event.get('subject'), event['duration']])
+
+        if event['origin'] == 'controller':
+            first = event['time'] - event['duration']
+            if host['first'] is None or first < host['first']:
+                host['first'] = first
+            if host['last'] is None or event['time'] > host['last']:
+                host['last'] = event['time']
+
+    for name, host in profile['hosts'].items():
+        host['wall'] = round(host.pop('last') - host.pop('first'), 3) \
+            if host['first'] is not None else 0.0
+        if profile['critical_path'] is None or host['wall'] > profile['hosts'][profile['critical_path']]['wall']:
+            profile['critical_path'] = name
+
+    return profile
+
+
+def load_previous_profile(profile):
+    '''Finds the latest saved profile of the same operation on the same config'''
+    if not os.path.isdir(profile_dir):
+        return None
+
+    for name in sorted(os.listdir(profile_dir), reverse=True):
+        try:
+            with open(profile_dir + '/' + name, 'r') as stream:
+                previous = json.load(stream)
+        except Exception:
+            continue
+
+        if previous['config'] == profile['config'] and previous['operation'] == profile['operation']:
+            return previous
+
+    return None
+
+
+def save_profile(config, profile):
+    '''Adds the profile to the history, dropping the oldest ones beyond the limit'''
+    os.makedirs(profile_dir, exist_ok=True)
+    name = time.strftime('%Y%m%d-%H%M%S', time.localtime(profile['started'])) + \
+        '-' + str(os.getpid()) + '.json'
+    with open(profile_dir + '/' + name, 'w') as stream:
+        json.dump(profile, stream)
+
+    history = sorted(os.listdir(profile_dir))
+    keep = int(get_setting(config, 'profile_history', default_profile_history))
+    for old in history[:max(0, len(history) - keep)]:
+        os.remove(profile_dir + '/' + old)
+
+
+def print_profile(profile, previous):
+    '''Prints where the time of a run went, compared with the previous run if there is one'''
+    if json_output:
+        print(json.dumps({'type': 'profile', 'profile': profile,
+                          'previous_wall': previous['wall'] if previous is not None else None}), flush=True)
+        return
+
+    print('')
+    print('PROFILE ' + profile['operation'] + ' took ' + '%.2f' % profile['wall'] + 's')
+
+    phases = sorted(profile['phases'].items(), key=lambda item: -item[1]['total'])
+    width = max([len('phase')] + [len(phase) for phase, _ in phases])
+    print('phase'.ljust(width) + '  count    total      max')
+    for phase, totals in phases:
+        print(phase.ljust(width) + '  ' + str(totals['count']).rjust(5) + '  ' +
+              ('%.2f' % totals['total']).rjust(7) + '  ' + ('%.2f' % totals['max']).rjust(7))
+
+    critical_path = profile['critical_path']
+    if critical_path is not None:
+        host = profile['hosts'][critical_path]
+        print('')
+        print('CRITICAL PATH ' + critical_path + ' ' + '%.2f' % host['wall'] + 's')
+        for phase, subject, duration in sorted(host['phases'], key=lambda item: -item[2]):
+            print('  ' + ('%.2f' % duration).rjust(7) + '  ' + phase +
+                  ('' if subject is None else ' ' + subject))
+
+    if previous is None:
+        return
+
+    print('')
+    print('COMPARED to ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(previous['started'])) +
+          ': ' + '%+.2f' % (profile['wall'] - previous['wall']) + 's')
+    changes = []
+    for phase in set(profile['phases']).union(previous['phases']):
+        before = previous['phases'][phase]['total'] if phase in previous['phases'] else 0.0
+        after = profile['phases'][phase]['total'] if phase in profile['phases'] else 0.0
+        changes.append((after - before, phase, before, after))
+    for change, phase, before, after in sorted(changes, key=lambda item: -abs(item[0]))[:5]:
+        print('  ' + ('%+.2f' % change).rjust(7) + '  ' + phase +
+              ' (' + '%.2f' % before + 's -> ' + '%.2f' % after + 's)')
+
+
+def format_seconds(seconds):
+    '''Formats a number of seconds as a short, rounded down duration'''
+    if seconds is None:
+        return '-'
+
+    seconds = int(seconds)
+    if seconds >= 86400:
+        return str(seconds // 86400) + 'd ' + str(seconds % 86400 // 3600) + 'h'
+    if seconds >= 3600:
+        return str(seconds // 3600) + 'h ' + str(seconds % 3600 // 60) + 'm'
+    if seconds >= 60:
+        return str(seconds // 60) + 'm ' + str(seconds % 60) + 's'
+    return str(seconds) + 's'
+
+
+def format_bytes(count):
+    '''Formats a number of bytes in the largest sensible unit'''
+    if count is None:
+        return '-'
+    for unit in ['B', 'K', 'M', 'G']:
+        if count < 1024:
+            return ('%.1f' % count).rstrip('0').rstrip('.') + unit
+        count /= 1024.0
+    return ('%.1f' % count) + 'T'
+
+
+def get_status_rows():
+    '''Gets the unit states reported by the nodes, as rows of the fleet table'''
+    rows = []
+    for event in events:
+        if event['status'] == 'STATE':
+            rows.append({'host': event['host'], 'service': event['subject'],
+                         'active': event['active'], 'sub': event['sub'],
+                         'uptime': event['uptime'], 'memory': event['memory']})
+    return sorted(rows, key=lambda row: (row['host'], row['service']))
+
+
+def print_status_table(rows, age=None):
+    '''Prints the fleet table of unit states, noting how old it is if it came from the cache'''
+    if json_output:
+        print(json.dumps({'type': 'status', 'rows': rows, 'age': age}), flush=True)
+        return
+
+    table = [['host', 'service', 'state', 'uptime', 'memory']] + \
+        [[row['host'], row['service'], str(row['active']) + ' (' + str(row['sub']) + ')',
+          format_seconds(row['uptime']), format_bytes(row['memory'])] for row in rows]
+    widths = [max(len(line[column]) for line in table) for column in range(5)]
+
+    print('')
+    for line in table:
+        print('  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip())
+    if age is not None:
+        print('(cached ' + '%.1f' % age + 's ago)')
+
+
+def get_status_cache_path(config_path, services):
+    '''Gets where the status of some services under a config is cached'''
+    key = get_file_hash(config_path) + ' ' + ' '.join(sorted(services))
+    return status_cache_dir + '/' + hashlib.sha1(key.encode()).hexdigest()[:16] + '.json'
+
+
+def load_cached_status(config, config_path, services):
+    '''Gets the cached status rows if they are fresher than the status TTL'''
+    try:
+        with open(get_status_cache_path(config_path, services), 'r') as stream:
+            cached = json.load(stream)
+    except Exception:
+        return None
+
+    age = time.time() - cached['time']
+    if age < 0 or age > float(get_setting(config, 'status_ttl', default_status_ttl)):
+        return None
+
+    return cached['rows'], age
+
+
+def save_cached_status(config_path, services, rows):
+    '''Caches status rows for repeated status calls'''
+    os.makedirs(status_cache_dir, exist_ok=True)
+    path = get_status_cache_path(config_path, services)
+    temp_path = path + '.' + str(os.getpid())
+    with open(temp_path, 'w') as stream:
+        json.dump({'time': time.time(), 'rows': rows}, stream)
+    os.replace(temp_path, path)
+
+
+def get_journal_path(run_id):
+    '''Gets where the journal of a run is kept'''
+    return run_dir + '/' + run_id + '.json'
+
+
+def load_journal(run_id):
+    '''Loads the journal of an earlier run, if there is one'''
+    try:
+        with open(get_journal_path(run_id), 'r') as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return None
+
+
+def save_journal(force=False):
+    '''Writes the journal out, at most once a second unless forced, so that
+    it is on disk however the run ends'''
+    global journal_saved
+
+    with journal_lock:
+        if journal is None or (not force and time.time() - journal_saved < journal_save_interval):
+            return
+        journal_saved = time.time()
+        data = json.dumps(journal)
+        path = get_journal_path(journal['id'])
+
+    os.makedirs(run_dir, exist_ok=True)
+    temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    with open(temp_path, 'w') as stream:
+        stream.write(data)
+    os.replace(temp_path, path)
+
+
+def start_journal(config, config_path, operation, services, hosts, previous=None):
+    '''Starts the journal of the run, or carries on with the journal of the
+    run being resumed, dropping the oldest journals beyond the limit'''
+    global journal
+
+    if previous is None:
+        journal = {'id': time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()),
+                   'config': os.path.abspath(config_path), 'operation': operation,
+                   'services': services, 'started': round(time.time(), 3), 'hosts': dict()}
+    else:
+        journal = previous
+        journal['resumed'] = journal.get('resumed', 0) + 1
+
+    journal['finished'] = None
+    journal['ok'] = None
+    for host in hosts:
+        entry = journal['hosts'].setdefault(host, {'plan_steps_done': 0})
+        entry['connection'] = get_connection(config, host)
+        # Every host the run goes back to has its steps recorded afresh
+        entry['steps'] = dict()
+        entry['plan_offset'] = 0
+
+    save_journal(True)
+
+    history = sorted(name for name in os.listdir(run_dir) if name.endswith('.json'))
+    keep = int(get_setting(config, 'run_history', default_run_history))
+    for old in history[:max(0, len(history) - keep)]:
+        if old != journal['id'] + '.json':
+            os.remove(run_dir + '/' + old)
+
+
+def finish_journal(ok):
+    '''Records how the run ended in its journal'''
+    if journal is None:
+        return
+    with journal_lock:
+        journal['finished'] = round(time.time(), 3)
+        journal['ok'] = ok
+    save_journal(True)
+
+
+def is_host_done(entry):
+    '''Works out whether a host finished every step of a journaled run'''
+    return entry is not None and len(entry['steps']) > 0 and \
+        all(status == 'ok' for status in entry['steps'].values())
+
+
+def journal_event(event):
+    '''Records the progress of a step the controller ran on a host'''
+    if journal is None or event['origin'] != 'controller' or event['host'] is None or \
+            event['status'] not in ['START', 'OK', 'ERROR']:
+        return
+
+    with journal_lock:
+        entry = journal['hosts'].get(event['host'])
+        # A step can run several times on a host, once per depends_on wave,
+        # and a host that failed any of them hasn't finished it
+        if entry is None or entry['steps'].get(event['step']) == 'failed':
+            return
+        entry['steps'][event['step']] = {'START': 'started', 'OK': 'ok', 'ERROR': 'failed'}[event['status']]
+
+    save_journal()
+
+
+def journal_attempt(host):
+    '''Notes that a chain of operations is starting afresh on a host, so its
+    results are counted from the beginning again'''
+    with journal_lock:
+        plan_progress[host] = {'done': 0, 'counting': True}
+
+
+def journal_result(host, result):
+    '''Counts how many of a chain of operations have succeeded in a row on a
+    host, so a retry or a resumed run can carry on from the first one that didn't'''
+    with journal_lock:
+        progress = plan_progress.get(host)
+        if progress is None or not progress['counting']:
+            return
+
+        if not result.get('ok'):
+            progress['counting'] = False
+            return
+
+        progress['done'] += 1
+        entry = journal['hosts'].get(host) if journal is not None else None
+        if entry is not None:
+            entry['plan_steps_done'] = entry['plan_offset'] + progress['done']
+
+
+def get_unfinished_plan(host, plan):
+    '''Drops the operations at the start of a plan which succeeded in the
+    last attempt on a host, so that a retry doesn't run them again'''
+    with journal_lock:
+        progress = plan_progress.get(host)
+        done = progress['done'] if progress is not None else 0
+        entry = journal['hosts'].get(host) if journal is not None else None
+        if entry is not None:
+            entry['plan_offset'] += done
+
+    return b''.join(plan.splitlines(keepends=True)[done:])
+
+
+def get_file_hash(path):
+    '''Gets the sha1 hex digest of a local file's contents'''
+    with open(path, 'rb') as stream:
+        return hashlib.sha1(stream.read()).hexdigest()
+
+
+def get_yaml_loader():
+    '''Gets the fastest safe YAML loader available, libyaml's if it is installed'''
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def index_config(config):
+    '''Adds lookups from hosts and sources to their services, and from services
+    to their hosts, to the config as _index'''
+    index = {'host_services': dict(), 'source_services': dict(), 'service_host': dict()}
+
+    # Older configs named the sources section source
+    if 'sources' not in config and 'source' in config:
+        config['sources'] = config.pop('source')
+
+    services = config.get('services')
+    for service, service_config in (services if isinstance(services, dict) else {}).items():
+        # Anything malformed is left for validate_config to report
+        if not isinstance(service_config, dict):
+            continue
+        host = service_config.get('host')
+        if isinstance(host, str):
+            index['service_host'][service] = host
+            index['host_services'].setdefault(host, []).append(service)
+        if isinstance(service_config.get('source'), str):
+            index['source_services'].setdefault(service_config['source'], []).append(service)
+
+    config['_index'] = index
+    return config
+
+
+def is_name_list(value):
+    '''Checks a value is a name, or a list of names, as depends_on takes'''
+    if isinstance(value, list):
+        return all(isinstance(name, str) for name in value)
+    return isinstance(value, str)
+
 
+def load_config(path):
+    '''Loads a config along with its indexes
 
-target_root = '/home/pi/zoidberg-deploy'
-target_script = target_root + '/zoidberg-deploy.py'
+    Each config is compiled to a pickle under ~/.zoidberg/configs, which is
+    reused for as long as the file's mtime and size, or failing that its
+    hash, are unchanged.'''
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    cache_path = config_cache_dir + '/' + \
+        hashlib.sha1(real_path.encode()).hexdigest()[:16] + '.pickle'
 
+    compiled = None
+    try:
+        with open(cache_path, 'rb') as stream:
+            compiled = pickle.load(stream)
+        if compiled['version'] != config_cache_version:
+            compiled = None
+    except Exception:
+        compiled = None
+
+    if compiled is not None and compiled['mtime'] == stat.st_mtime_ns and compiled['size'] == stat.st_size:
+        return compiled['config']
+
+    with open(real_path, 'rb') as stream:
+        data = stream.read()
+    file_hash = hashlib.sha1(data).hexdigest()
+
+    if compiled is not None and compiled['hash'] == file_hash:
+        config = compiled['config']
+    else:
+        config = yaml.load(data, Loader=get_yaml_loader())
+        # An empty file, or one that isn't a mapping, is left for
+        # validate_config to report rather than being indexed or cached
+        if not isinstance(config, dict):
+            return config
+        config = index_config(config)
+
+    try:
+        os.makedirs(config_cache_dir, exist_ok=True)
+        temp_path = cache_path + '.' + str(os.getpid())
+        with open(temp_path, 'wb') as stream:
+            pickle.dump({'version': config_cache_version, 'mtime': stat.st_mtime_ns,
+                         'size': stat.st_size, 'hash': file_hash, 'config': config}, stream)
+        os.replace(temp_path, cache_path)
+    except Exception as e:
+        log('Couldn\'t cache the config: ' + str(e))
+
+    return config
 
-def get_temp_target_config():
-    return target_root + '/deploy_' + str(random.randrange(100000, 999999)) + ".yaml"
+
+def validate_config(config):
+    '''Checks the whole config up front, returning a list of its problems'''
+    problems = []
+
+    if not isinstance(config, dict):
+        return ['The config must be a mapping']
+
+    for section in ['hosts', 'services', 'sources', 'settings']:
+        if config.get(section) is not None and not isinstance(config[section], dict):
+            problems.append(section + ' must be a mapping')
+            config[section] = dict()
+    for section in ['hosts', 'services']:
+        if not config.get(section):
+            problems.append('There are no ' + section)
+
+    hosts = config.get('hosts') or {}
+    sources = config.get('sources') or {}
+    services = config.get('services') or {}
+
+    for host, host_config in hosts.items():
+        if not isinstance(host_config, dict) or not host_config.get('ip'):
+            problems.append('Host ' + str(host) + ' has no ip')
+            continue
+
+        for key in ['user', 'root', 'systemd_dir']:
+            if key in host_config and not isinstance(host_config[key], str):
+                problems.append('Host ' + str(host) + ' ' + key + ' must be a string')
+        for key in ['root', 'systemd_dir']:
+            if isinstance(host_config.get(key), str) and not host_config[key].startswith('/'):
+                problems.append('Host ' + str(host) + ' ' + key + ' must be an absolute path')
+
+    for source, source_config in sources.items():
+        if not isinstance(source_config, dict) or not source_config.get('source'):
+            problems.append('Source ' + str(source) + ' has no source URI')
+
+    for service, service_config in services.items():
+        if not isinstance(service_config, dict):
+            problems.append('Service ' + str(service) + ' must be a mapping')
+            continue
+
+        if 'host' not in service_config:
+            problems.append('Service ' + str(service) + ' has no host')
+        elif not isinstance(service_config['host'], str):
+            problems.append('Service ' + str(service) + ' host must be a string')
+        elif service_config['host'] not in hosts:
+            problems.append('Service ' + str(service) + ' is on unknown host ' + str(service_config['host']))
+
+        is_system = 'system' in service_config and service_config['system']
+        if 'source' in service_config:
+            if not isinstance(service_config['source'], str):
+                problems.append('Service ' + str(service) + ' source must be a string')
+            elif service_config['source'] not in sources:
+                problems.append('Service ' + str(service) + ' uses unknown source ' + str(service_config['source']))
+        elif not is_system:
+            problems.append('Service ' + str(service) + ' has no source and isn\'t a system service')
+
+        for key in ['apt', 'pip']:
+            if key in service_config and not isinstance(service_config[key], list):
+                problems.append('Service ' + str(service) + ' ' + key + ' must be a list')
+
+        if service_config.get('depends_on') is not None and not is_name_list(service_config['depends_on']):
+            problems.append('Service ' + str(service) + ' depends_on must be a service or a list of services')
+            continue
+
+        for dependency in get_dependencies(config, service):
+            if dependency not in services:
+                problems.append('Service ' + str(service) + ' depends on unknown service ' + str(dependency))
+
+    # An empty list would order every service, malformed ones included
+    ordered = [service for service in services if isinstance(services[service], dict) and
+               is_name_list(services[service].get('depends_on') or [])]
+    if len(ordered) > 0:
+        try:
+            get_service_waves(config, ordered)
+        except Exception as e:
+            problems.append(str(e))
+
+    for name, value in (config.get('settings') or {}).items():
+        if name not in setting_types:
+            log('Ignoring unknown setting ' + str(name))
+        elif isinstance(value, bool) and setting_types[name] is not bool or \
+                not isinstance(value, setting_types[name]):
+            problems.append('Setting ' + name + ' has the wrong type')
+
+    if get_setting(config, 'systemctl_mode', 'batch') not in ['batch', 'concurrent', 'serial']:
+        problems.append('Setting systemctl_mode must be batch, concurrent or serial')
+    rolling = get_setting(config, 'rolling')
+    if rolling is not None and not re.match(rolling_pattern, str(rolling)):
+        problems.append('Setting rolling must be a number of hosts, or a percentage of them')
+    for name in ['root', 'systemd_dir']:
+        if isinstance(get_setting(config, name), str) and not get_setting(config, name).startswith('/'):
+            problems.append('Setting ' + name + ' must be an absolute path')
+
+    return problems
+
+
+def load_local_prereqs(source_config):
+    '''Reads a source's prereqs.yaml from the controller's copy of it, if there is one'''
+    cache_dir = local_git_cache + '/' + get_git_cache_name(source_config['source'])
+    if not os.path.isdir(cache_dir):
+        return None
+
+    try:
+        data = subprocess.check_output(
+            ['git', 'show', 'refs/heads/' + get_source_branch(source_config) + ':prereqs.yaml'],
+            cwd=cache_dir, stderr=subprocess.DEVNULL)
+        return yaml.load(data, Loader=get_yaml_loader()) or {}
+    except Exception:
+        return None
+
+
+def get_plan_steps(config, operation, host_services, waves, args):
+    '''Works out the steps an operation would take on a host running the services'''
+    steps = []
+    source_services = dict()
+    packages = {'apt': set(), 'pip': set()}
+
+    for service in host_services:
+        service_config = config['services'][service]
+        if 'source' in service_config:
+            source_services.setdefault(service_config['source'], []).append(service)
+        else:
+            for key in packages:
+                packages[key].update(service_config.get(key) or [])
+
+    script_name = 'setup' if operation == 'install' else 'update'
+    source_prereqs = dict()
+    for source in sorted(source_services):
+        source_prereqs[source] = load_local_prereqs(config['sources'][source])
+
+    if operation in ['install', 'update']:
+        for source in sorted(source_services):
+            source_config = config['sources'][source]
+            steps.append(('Installing ' if operation == 'install' else 'Updating ') + source + ' from ' +
+                         source_config['source'] + ' ' + get_source_branch(source_config))
+
+    if operation == 'install':
+        for service in host_services:
+            if 'source' in config['services'][service]:
+                steps.append('Symlink ' + service + '.service')
+
+    if operation in ['sideload', 'watch']:
+        steps.append('Sync ' + str(args.source) + ' to the sideload dir of ' + ', '.join(sorted(source_services)))
+
+    if operation in ['install', 'update', 'sideload', 'watch']:
+        for source in sorted(source_services):
+            source_prereq = source_prereqs[source]
+            if source_prereq is None:
+                steps.append(script_name + ' scripts for ' + source + ': unknown until it is fetched with --push-sources')
+                continue
+
+            if operation == 'install':
+                for key in packages:
+                    packages[key].update(source_prereq.get(key) or [])
+                    for service, prereq_service in (source_prereq.get('services') or {}).items():
+                        if service in host_services and prereq_service:
+                            packages[key].update(prereq_service.get(key) or [])
+
+            for key in [script_name, script_name + '_root']:
+                commands = list(source_prereq.get(key) or [])
+                for service, prereq_service in (source_prereq.get('services') or {}).items():
+                    if service in host_services and prereq_service:
+                        commands.extend(prereq_service.get(key) or [])
+                if len(commands) > 0:
+                    steps.append(key + ' scripts for ' + source + ': ' + '; '.join(commands))
+
+        if operation == 'install' and args.no_prereqs:
+            for key in ['apt', 'pip']:
+                if len(packages[key]) > 0:
+                    steps.append(key + ' package install: ' + ', '.join(sorted(packages[key])))
+
+        steps.append('update systemctl if any units changed')
+
+    if operation == 'rollback':
+        for source in sorted(source_services):
+            steps.append('Roll back ' + source + ' to its previous release')
+        steps.append('update systemctl if any units changed')
+        steps.append('systemctl restart ' + ' '.join(
+            service for service in host_services if 'source' in config['services'][service]))
+
+    if operation in ['start', 'run', 'stop', 'restart'] or \
+            (operation in ['update', 'sideload'] and args.restart) or operation == 'watch':
+        command = 'start' if operation == 'run' else operation
+        if command not in ['start', 'stop']:
+            command = 'restart'
+        # Restarts after updating code only touch the services with a source
+        restart_services = host_services if operation in ['start', 'run', 'stop', 'restart'] else \
+            [service for service in host_services if 'source' in config['services'][service]]
+        host_waves = [[service for service in wave if service in restart_services] for wave in waves]
+        if command == 'stop':
+            host_waves.reverse()
+        for wave in host_waves:
+            if len(wave) > 0:
+                steps.append('systemctl ' + command + ' ' + ' '.join(wave) +
+                             (' (if its source changed)' if operation == 'update' and not args.force else ''))
+    elif operation in ['status', 'health']:
+        steps.append(operation + ' ' + ' '.join(host_services))
+    elif operation not in ['install', 'update', 'sideload', 'rollback']:
+        steps.append(operation)
+
+    return steps
+
+
+def plan(config, hosts, services, operations, args):
+    '''Prints what the operations would do on each host, without touching any of them'''
+    waves = get_service_waves(config, services)
+    plan_hosts = dict()
+
+    for host in sorted(hosts):
+        host_services = get_services_for_host(config, host, services)
+        if len(host_services) == 0:
+            continue
+
+        steps = []
+        for operation in operations:
+            steps.extend(get_plan_steps(config, operation, host_services, waves, args))
+        plan_hosts[host] = dict(get_host_layout(config, host), connection=get_connection(config, host),
+                                services=host_services, steps=steps)
+
+    if json_output:
+        print(json.dumps({'type': 'plan', 'operations': operations, 'hosts': plan_hosts}), flush=True)
+        return
+
+    print('PLAN ' + ', '.join(operations) + ' on ' + str(len(plan_hosts)) + ' hosts')
+    for host, host_plan in plan_hosts.items():
+        print('')
+        print(host + ' (' + host_plan['connection'] + '): ' + ', '.join(host_plan['services']))
+        print('  in ' + host_plan['root'] + ', units in ' + host_plan['systemd_dir'])
+        for step in host_plan['steps']:
+            print('  ' + step)
+
+
+def get_cached_target_path(local_path, prefix, suffix):
+    '''Gets the content addressed path a local file is kept at on the targets,
+    relative to each target's root'''
+    return 'cache/' + prefix + '-' + get_file_hash(local_path) + suffix
+
+
+def get_git_cache_name(source_uri):
+    '''Gets the name of the bare repository a source URI is cached in, locally and on the targets'''
+    return hashlib.sha1(source_uri.encode()).hexdigest()[:16] + '.git'
+
+
+def get_source_branch(source_config):
+    '''Gets the branch configured for a source'''
+    if 'branch' in source_config:
+        return source_config['branch']
+    return 'master'
+
+
+def get_setting(config, name, default=None):
+    '''Gets a value from the optional settings section of the config'''
+    if 'settings' in config and config['settings'] is not None and name in config['settings']:
+        return config['settings'][name]
+    return default
+
+
+def start_executor(config, parallel):
+    '''Creates the shared worker pool that all per-host jobs are queued on'''
+    global executor
+
+    if parallel is None:
+        parallel = get_setting(config, 'parallel', default_parallel)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, int(parallel)))
+
+
+def run_jobs(jobs):
+    '''Queues (function, args) jobs on the shared worker pool and waits for them all'''
+    futures = [executor.submit(job, *job_args) for job, job_args in jobs]
+
+    for future in futures:
+        future.result()
 
 
 def get_connection(config, host_name):
@@ -22,121 +962,596 @@ def get_connection(config, host_name):
         return host_details['ip']
 
 
+def get_host_layout(config, host_name):
+    '''Gets where zoidberg deploy keeps its tree and links systemd units on a host
+
+    Both default to places under the home directory of the user it connects
+    as, and can be set per host or for every host in the settings.'''
+    host_details = config['hosts'][host_name]
+    user = host_details.get('user', default_user)
+    home = '/root' if user == 'root' else '/home/' + user
+
+    root = host_details.get('root') or get_setting(config, 'root') or \
+        home + '/zoidberg-deploy'
+    systemd_dir = host_details.get('systemd_dir') or get_setting(config, 'systemd_dir') or \
+        home + '/.config/systemd/user'
+
+    return {'root': root.rstrip('/'), 'systemd_dir': systemd_dir.rstrip('/')}
+
+
+def load_host_layouts(config, hosts):
+    '''Works out the connection and layout of every host being deployed to,
+    keyed by host name, as several hosts can share a machine'''
+    for host in hosts:
+        host_connections[host] = get_connection(config, host)
+        host_layouts[host] = get_host_layout(config, host)
+
+
+def get_target_path(host, path=None):
+    '''Gets an absolute path within the deploy root of a host'''
+    root = host_layouts[host]['root']
+    if path is None:
+        return root
+    return root + '/' + path
+
+
+def get_deploy_command(host, remote_config, command):
+    '''Gets the command line which runs zoidberg deploy for a host,
+    telling it where its tree and the systemd units live there'''
+    layout = host_layouts[host]
+    return ['python', get_target_path(host, target_script),
+            '--root', layout['root'], '--systemd-dir', layout['systemd_dir'],
+            get_target_path(host, remote_config), command]
+
+
+def get_ssh_options():
+    '''Gets the ssh options which route a command over the host's control master'''
+    return ['-o', 'ControlPath=' + control_dir + '/%C', '-o', 'ConnectTimeout=' + str(connect_timeout)]
+
+
+def get_ssh_command(host, commands):
+    '''Builds an ssh command line for the host, reusing its control master'''
+    return ['ssh'] + get_ssh_options() + [host_connections[host]] + commands
+
+
+def thread_open_connection(connection):
+    '''Worker which opens a persistent control master for the connection'''
+    started = time.time()
+    try:
+        subprocess.check_call(
+            ['ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPersist=' + control_persist] +
+            get_ssh_options() + [connection, 'true'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        report_time('open connection', connection, started)
+    except Exception as e:
+        # Commands connect directly without a master, and retry from there
+        log('Couldn\'t open a connection to ' + connection + ': ' + str(e))
+
+
+def ensure_connection(host):
+    '''Opens the control master for a host's machine as part of the first job
+    run over it, at most once per run, so no host waits on any other's
+    handshake. The hosts on one machine share its master.'''
+    connection = host_connections[host]
+    with opened_connections_lock:
+        opened = opened_connections.setdefault(connection, {'lock': threading.Lock(), 'done': False})
+
+    with opened['lock']:
+        if not opened['done']:
+            thread_open_connection(connection)
+            opened['done'] = True
+
+
+def close_connections(config, hosts):
+    '''Closes the control masters opened for the hosts'''
+    for connection in sorted(set(host_connections[host] for host in hosts)):
+        subprocess.call(['ssh', '-O', 'exit'] + get_ssh_options() + [connection],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_daemon_socket(host):
+    '''Gets the socket the node daemon for the current deploy script listens on'''
+    return get_target_path(host, 'run/' + os.path.basename(target_script)[:-len('.py')] + '.sock')
+
+
+def get_daemon_pattern(host):
+    '''Gets a pkill pattern matching only the node daemons under the host's root'''
+    root = get_target_path(host)
+    return shlex.quote('[' + root[0] + ']' + root[1:] + '/cache/zoidberg-deploy-.* daemon$')
+
+
+def connect_daemon(host):
+    '''Connects to the host's node daemon through a socket forwarded over the
+    host's control master, returning None if that isn't possible'''
+    remote_socket = get_daemon_socket(host)
+    local_socket = control_dir + '/' + \
+        hashlib.sha1((host_connections[host] + ':' + remote_socket).encode()).hexdigest()[:16] + '.sock'
+
+    for attempt in range(2):
+        if os.path.exists(local_socket):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(local_socket)
+                return client
+            except OSError:
+                # Left behind by a control master that has since gone away
+                client.close()
+                os.remove(local_socket)
+
+        if attempt == 0 and subprocess.call(
+                ['ssh', '-O', 'forward', '-L', local_socket + ':' + remote_socket] +
+                get_ssh_options() + [host_connections[host]],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+            return None
+
+    return None
+
+
 def get_services_for_host(config, host, services):
     '''Helper to return which services apply to the specified host'''
+    host_services = config['_index']['host_services'].get(host, [])
+
+    if len(services) == 0:
+        return list(host_services)
+
+    services = set(services)
+    return [service for service in host_services if service in services]
+
+
+def get_dependencies(config, service):
+    '''Gets the services that the specified service depends on'''
+    service_config = config['services'][service]
+    if 'depends_on' not in service_config or service_config['depends_on'] is None:
+        return []
+
+    dependencies = service_config['depends_on']
+    if isinstance(dependencies, str):
+        return [dependencies]
+    if not is_name_list(dependencies):
+        return []
+    return list(dependencies)
+
+
+def get_service_waves(config, services):
+    '''Orders services into waves using their depends_on, where every service
+    only depends on services in earlier waves. Dependencies outside of the
+    services being acted on are ignored.'''
     if len(services) == 0:
         services = config['services'].keys()
 
-    found_services = []
+    remaining = set(services)
+    waves = []
 
-    for service in services:
-        if config['services'][service]['host'] == host:
-            found_services.append(service)
+    while len(remaining) > 0:
+        wave = sorted(service for service in remaining
+                      if not any(dependency in remaining for dependency in get_dependencies(config, service)))
+
+        if len(wave) == 0:
+            raise Exception('Circular depends_on between services: ' +
+                            ', '.join(sorted(remaining)))
 
-    return found_services
+        waves.append(wave)
+        remaining.difference_update(wave)
 
+    return waves
 
-def thread_execute_on_connection(connection, desc, commands):
-    '''Helper to call one or more commands on a connection'''
-    print('START ' + desc + ' ' + connection)
+
+def execute_remote_service_waves(config, remote_config, hosts, services, command, description, reverse=False):
+    '''Executes a remote zoidberg command wave by wave, in dependency order,
+    running everything within a wave in parallel across hosts'''
     try:
-        subprocess.check_call(['ssh', connection] + commands,
-                              stderr=subprocess.STDOUT)
-        print('OK ' + desc + ' ' + connection)
-    except:
-        print('ERROR ' + desc + ' ' + connection)
+        waves = get_service_waves(config, services)
+    except Exception as e:
+        report('ERROR', 'order services', error=e)
+        return
+
+    if reverse:
+        waves.reverse()
+
+    for index, wave in enumerate(waves):
+        if len(waves) > 1:
+            log('WAVE ' + str(index + 1) + '/' + str(len(waves)) +
+                ' ' + ', '.join(wave))
+
+        execute_remote_service_command(
+            config, remote_config, hosts, wave, command, description)
+
+
+def thread_execute_on_connection(host, desc, commands, stdin_data=None):
+    '''Helper to call one or more commands on a host, optionally feeding them some input'''
+    if not ensure_zoidberg_deploy(host):
+        report('ERROR', desc, host)
+        return
+
+    report('START', desc, host)
+    attempt = 0
+    while True:
+        journal_attempt(host)
+        try:
+            process = subprocess.Popen(get_ssh_command(host, commands),
+                                       stdin=None if stdin_data is None else subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if stdin_data is not None:
+                process.stdin.write(stdin_data)
+                process.stdin.close()
+
+            for line in process.stdout:
+                handle_remote_line(host, line.decode(errors='replace').rstrip('\n'))
+
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, commands)
+            report('OK', desc, host)
+        except subprocess.CalledProcessError as e:
+            # ssh exits with 255 when the connection itself failed, rather
+            # than the command, which is worth another go after a while
+            if e.returncode == 255 and attempt < retries:
+                if stdin_data is not None:
+                    stdin_data = get_unfinished_plan(host, stdin_data)
+                    if len(stdin_data) == 0:
+                        report('OK', desc, host)
+                        return
+
+                delay = retry_backoff * 2 ** attempt
+                attempt += 1
+                log('RETRY ' + desc + ' ' + host + ' in ' + str(delay) + 's (' +
+                    str(attempt) + '/' + str(retries) + ')')
+                time.sleep(delay)
+                continue
+            report('ERROR', desc, host, e)
+        except Exception as e:
+            report('ERROR', desc, host, e)
+        return
+
+
+def thread_execute_on_daemon(host, desc, commands, plan):
+    '''Helper to send a plan to the host's node daemon, falling back to running
+    the commands over ssh if there is no daemon to answer'''
+    if not ensure_zoidberg_deploy(host):
+        report('ERROR', desc, host)
+        return
+
+    client = connect_daemon(host)
+    if client is None:
+        thread_execute_on_connection(host, desc, commands, plan)
+        return
+
+    received = []
+    journal_attempt(host)
+    try:
+        with client:
+            client.sendall(plan)
+            client.shutdown(socket.SHUT_WR)
+
+            for line in client.makefile('rb'):
+                line = line.decode(errors='replace').rstrip('\n')
+                if len(received) == 0:
+                    report('START', desc + ' (daemon)', host)
+                received.append(line)
+                handle_remote_line(host, line)
+    except Exception as e:
+        report('ERROR', desc + ' (daemon)', host, e)
+        return
+
+    # The forward accepts connections even when no daemon is listening at
+    # the far end, in which case it closes again without a word
+    if len(received) == 0:
+        thread_execute_on_connection(host, desc, commands, plan)
+        return
+
+    results = [json.loads(line[len('RESULT '):]) for line in received
+               if line.startswith('RESULT ')]
+    if not all(result['ok'] for result in results):
+        report('ERROR', desc + ' (daemon)', host)
+        return
+
+    report('OK', desc + ' (daemon)', host)
+
+    # A daemon that dies partway through a plan leaves the rest unanswered,
+    # which the agent then runs over ssh
+    steps = len(plan.splitlines())
+    if len(results) < steps:
+        log('Daemon on ' + host + ' stopped after ' + str(len(results)) + ' of ' +
+            str(steps) + ' operations, running the rest over ssh')
+        thread_execute_on_connection(host, desc, commands,
+                                     get_unfinished_plan(host, plan))
 
 
 def execute_remote_service_command(config, remote_config, hosts, services, command, description, extra_args=[]):
     '''Helper for executing remote zoidberg commands'''
-    threads = []
-    args = ['python', target_script, remote_config, command]
+    jobs = []
 
     for host in hosts:
-        connection = get_connection(config, host)
         host_services = get_services_for_host(config, host, services)
 
         if len(host_services) == 0:
             continue
 
-        thread = threading.Thread(
-            target=thread_execute_on_connection, args=(connection, description, args + host_services + extra_args))
-        threads.append(thread)
-        thread.start()
+        jobs.append((thread_execute_on_connection,
+                     (host, description,
+                      get_deploy_command(host, remote_config, command) + host_services +
+                      extra_args + remote_args)))
 
-    for thread in threads:
-        thread.join()
+    run_jobs(jobs)
 
 
-def start(config, remote_config, hosts, services):
-    '''Start specified or all services'''
+def get_rolling_batches(config, hosts, services, rolling):
+    '''Splits the hosts running the services into batches for a rolling
+    operation, of either a number of hosts or a percentage of them'''
+    hosts = sorted(host for host in hosts
+                   if len(get_services_for_host(config, host, services)) > 0)
+
+    if rolling.endswith('%'):
+        size = -(-len(hosts) * float(rolling[:-1]) // 100)
+    else:
+        size = int(rolling)
+    size = max(1, int(size))
+
+    return [hosts[index:index + size] for index in range(0, len(hosts), size)]
+
+
+def execute_rolling(config, remote_config, hosts, services, rolling, description, execute):
+    '''Runs an operation on a batch of hosts at a time, checking the health of
+    the services on each batch before starting the next, and stopping the
+    rollout at the first batch that fails'''
+    batches = get_rolling_batches(config, hosts, services, rolling)
+
+    for index, batch in enumerate(batches):
+        log('BATCH ' + str(index + 1) + '/' + str(len(batches)) + ' ' + ', '.join(batch))
+
+        first_event = len(events)
+        execute(batch)
+
+        # No point waiting for services to become healthy if they failed
+        if not any(event['status'] == 'ERROR' for event in events[first_event:]):
+            execute_remote_service_command(
+                config, remote_config, batch, services, 'health', 'Checking health')
+
+        if any(event['status'] == 'ERROR' for event in events[first_event:]):
+            report('ERROR', description + ' stopped after batch ' +
+                   str(index + 1) + '/' + str(len(batches)))
+            return
+
+
+def health(config, remote_config, hosts, services):
+    '''Checks the health of specified or all services'''
     execute_remote_service_command(
+        config, remote_config, hosts, services, 'health', 'Checking health')
+
+
+def start(config, remote_config, hosts, services):
+    '''Start specified or all services, dependencies first'''
+    execute_remote_service_waves(
         config, remote_config, hosts, services, 'start', 'Starting services')
 
 
 def stop(config, remote_config, hosts, services):
-    '''Stop specified or all services'''
-    execute_remote_service_command(
-        config, remote_config, hosts, services, 'stop', 'Stopping services')
-
+    '''Stop specified or all services, dependents first'''
+    execute_remote_service_waves(
+        config, remote_config, hosts, services, 'stop', 'Stopping services', reverse=True)
+
+
+def restart(config, remote_config, hosts, services, rolling=None):
+    '''Restart specified or all services, dependencies first, optionally a
+    batch of hosts at a time'''
+    if rolling is not None:
+        execute_rolling(config, remote_config, hosts, services, rolling, 'Rolling restart',
+                        lambda batch: execute_remote_service_waves(
+                            config, remote_config, batch, services, 'restart', 'Restarting services'))
+        return
 
-def restart(config, remote_config, hosts, services):
-    '''Restart specified or all services'''
-    execute_remote_service_command(
+    execute_remote_service_waves(
         config, remote_config, hosts, services, 'restart', 'Restarting services')
 
 
-def status(config, remote_config, hosts, services):
+def status(config, remote_config, hosts, services, compact):
     '''Get status of specified or all services'''
     execute_remote_service_command(
-        config, remote_config, hosts, services, 'status', 'Getting status')
+        config, remote_config, hosts, services, 'status', 'Getting status',
+        ['--compact'] if compact else [])
 
 
-def update(config, remote_config, hosts, services, restart):
-    '''Update specified or all services'''
+def update(config, remote_config, hosts, services, restart, force, only_changed, rolling=None):
+    '''Update specified or all services. Update scripts and restarts only
+    happen for sources that actually changed, unless forced. Restarting
+    updates can be rolled out a batch of hosts at a time.'''
     args = ['-r'] if restart else []
+    if force:
+        args.append('--force')
+    if only_changed:
+        args.append('--only-changed')
+
+    if restart and rolling is not None:
+        execute_rolling(config, remote_config, hosts, services, rolling, 'Rolling update',
+                        lambda batch: execute_remote_service_command(
+                            config, remote_config, batch, services, 'update', 'Updating services', args))
+        return
+
     execute_remote_service_command(
         config, remote_config, hosts, services, 'update', 'Updating services', args)
 
 
-def sideload(config, remote_config, hosts, services, source, restart):
-    '''Sideload a specified service with local code'''
-    if len(services) != 1:
-        print('ERROR Must be only one service when sideloading')
+def rollback(config, remote_config, hosts, services, rolling=None):
+    '''Switches the services' sources back to their previous releases and
+    restarts them, optionally a batch of hosts at a time'''
+    if rolling is not None:
+        execute_rolling(config, remote_config, hosts, services, rolling, 'Rolling rollback',
+                        lambda batch: execute_remote_service_command(
+                            config, remote_config, batch, services, 'rollback', 'Rolling back services'))
         return
 
-    args = ['-r'] if restart else []
+    execute_remote_service_command(
+        config, remote_config, hosts, services, 'rollback', 'Rolling back services')
 
-    if source is None:
-        print('ERROR Source must be specified for sideloading')
-        return
 
-    service = next(iter(services))
-    host = next(iter(hosts))
-    connection = get_connection(config, host)
-    sideload_dir = target_root + '/sideload-' + service
+def thread_sideload_to_connection(host, local_source, sideload_dir, desc, commands):
+    '''Worker which syncs local code into a host's sideload dir and then sideloads it
 
-    try:
-        # Empty existing sideload dir
-        subprocess.check_call(['ssh', connection, 'rm', '-rf', sideload_dir],
-                              stderr=subprocess.STDOUT)
+    The sideload dir is kept between runs, so rsync only sends what changed.'''
+    if not ensure_zoidberg_deploy(host):
+        report('ERROR', desc, host)
+        return
 
-        # rsync over the files to be sideloaded
-        print('START syncing files to target')
+    report('START', 'syncing files to', host)
+    try:
         subprocess.check_call(
-            ['rsync', '-a', '--exclude', '\'.*\'', source, connection + ':' + sideload_dir], stderr=subprocess.STDOUT)
-
-        # Excute update on target
-        execute_remote_service_command(
-            config, remote_config, hosts, services, 'sideload', 'Sideloading ' + service, args)
+            ['rsync', '-a', '--delete', '-e', ' '.join(['ssh'] + get_ssh_options()),
+             '--rsync-path', 'mkdir -p ' + shlex.quote(sideload_dir) + ' && rsync',
+             '--exclude', '.*', local_source, host_connections[host] + ':' + sideload_dir],
+            stderr=subprocess.STDOUT)
+        report('OK', 'syncing files to', host)
     except Exception as e:
-        print(e)
-        print('ERROR sideload ' + service + ' to ' + connection)
+        report('ERROR', 'syncing files to', host, e)
+        return
+
+    thread_execute_on_connection(host, desc, commands)
+
+
+def sideload(config, remote_config, hosts, services, source, restart):
+    '''Sideload local code for the specified services, to every host running them'''
+    if len(services) == 0:
+        report('ERROR', 'Must specify the services to sideload')
+        return False
+
+    if source is None:
+        report('ERROR', 'Source must be specified for sideloading')
+        return False
+
+    # System services have nothing to sideload
+    services = [service for service in services
+                if 'source' in config['services'][service]]
+    service_sources = set(config['services'][service]['source']
+                          for service in services)
+
+    if len(service_sources) != 1:
+        report('ERROR', 'Sideloaded services must all share exactly one source')
+        return False
 
+    service_source = next(iter(service_sources))
+    # Sync the contents of the local directory, not the directory itself
+    local_source = os.path.join(source, '')
+    extra_args = ['-r'] if restart else []
+    jobs = []
 
-def install(config, remote_config, hosts, services, execute_prereqs):
+    for host in hosts:
+        host_services = get_services_for_host(config, host, services)
+
+        if len(host_services) == 0:
+            continue
+
+        jobs.append((thread_sideload_to_connection,
+                     (host, local_source,
+                      get_target_path(host, 'sideload/' + service_source),
+                      'Sideloading ' + service_source,
+                      get_deploy_command(host, remote_config, 'sideload') + host_services +
+                      extra_args + remote_args)))
+
+    run_jobs(jobs)
+    return True
+
+
+def get_source_snapshot(source):
+    '''Gets the modification time and size of every file in a local source,
+    skipping hidden ones as sideloading does'''
+    snapshot = dict()
+
+    for directory, directories, files in os.walk(source):
+        directories[:] = [name for name in directories if not name.startswith('.')]
+        for name in files:
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+
+    return snapshot
+
+
+def thread_read_changes(process, changes):
+    '''Worker which queues each path inotifywait reports as changed'''
+    for line in process.stdout:
+        changes.put(line.decode(errors='replace').rstrip('\n'))
+
+    # Let the watch know that inotifywait has gone away
+    changes.put(None)
+
+
+def thread_poll_changes(source, changes):
+    '''Worker which polls a local source for changes, where inotifywait isn't available'''
+    snapshot = get_source_snapshot(source)
+
+    while True:
+        time.sleep(watch_poll_interval)
+        current = get_source_snapshot(source)
+        for path in set(snapshot).union(current):
+            if snapshot.get(path) != current.get(path):
+                changes.put(path)
+        snapshot = current
+
+
+def watch(config, remote_config, hosts, services, source):
+    '''Sideloads local code for the specified services, then sideloads it again
+    and restarts them every time it changes, until interrupted
+
+    Each sideload only sends the files that changed, and only goes to the
+    hosts running the specified services.'''
+    if not sideload(config, remote_config, hosts, services, source, True):
+        return
+
+    debounce = float(get_setting(config, 'watch_debounce', default_watch_debounce))
+    changes = queue.Queue()
+    process = None
+
+    if shutil.which('inotifywait') is not None:
+        process = subprocess.Popen(['inotifywait', '-m', '-r', '-q', '--exclude', '/\\.',
+                                    '-e', 'close_write,create,delete,move', '--format', '%w%f', source],
+                                   stdout=subprocess.PIPE)
+        threading.Thread(target=thread_read_changes,
+                         args=(process, changes), daemon=True).start()
+    else:
+        threading.Thread(target=thread_poll_changes,
+                         args=(source, changes), daemon=True).start()
+
+    log('Watching ' + source + ' for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            changed = set([changes.get()])
+
+            # Editors and builds tend to write several files at once, so wait
+            # for them to settle rather than syncing each one
+            while True:
+                try:
+                    changed.add(changes.get(timeout=debounce))
+                except queue.Empty:
+                    break
+
+            if None in changed:
+                report('ERROR', 'inotifywait stopped watching ' + source)
+                return
+
+            started = time.time()
+            log(str(len(changed)) + ' changed: ' + ', '.join(sorted(changed)[:5]) +
+                (', ...' if len(changed) > 5 else ''))
+            sideload(config, remote_config, hosts, services, source, True)
+            log('Synced in ' + '%.2f' % (time.time() - started) + 's')
+    except KeyboardInterrupt:
+        log('Stopped watching ' + source)
+    finally:
+        if process is not None:
+            process.terminate()
+
+
+def install(config, remote_config, hosts, services, execute_prereqs, refresh_prereqs, wheelhouse):
     '''Install specified or all services'''
     args = [] if execute_prereqs else ['-p']
+    if refresh_prereqs:
+        args.append('--refresh-prereqs')
+    if wheelhouse is not None:
+        push_wheelhouse(config, hosts, wheelhouse)
+        args.append('--wheels')
 
     execute_remote_service_command(
         config, remote_config, hosts, services, 'install', 'Installing services', args)
@@ -150,26 +1565,21 @@ def ping(config, remote_config, hosts, services):
 
 def install_prereqs(config, remote_config, hosts):
     '''Installs zoidberg prereqs on the target hosts'''
-    threads = []
-    args = ['python', target_script, remote_config, 'install-prereqs']
+    jobs = []
 
     for host in hosts:
-        connection = get_connection(config, host)
-
-        thread = threading.Thread(
-            target=thread_execute_on_connection, args=(connection, 'Installing prerequisites', args))
-        threads.append(thread)
-        thread.start()
+        jobs.append((thread_execute_on_connection,
+                     (host, 'Installing prerequisites',
+                      get_deploy_command(host, remote_config, 'install-prereqs') +
+                      remote_args)))
 
-    for thread in threads:
-        thread.join()
+    run_jobs(jobs)
 
 
 def shutdown(config, remote_config, hosts):
     '''Shuts down the specified hosts'''
-    threads = []
+    jobs = []
     masters = set()
-    args = ['python', target_script, remote_config, 'shutdown']
 
     for host in hosts:
         if 'master' in config['hosts'][host] and config['hosts'][host]['master']:
@@ -177,50 +1587,199 @@ def shutdown(config, remote_config, hosts):
             masters.add(host)
             continue
 
-        connection = get_connection(config, host)
-        thread = threading.Thread(
-            target=thread_execute_on_connection, args=(connection, 'Shutting down', args))
-        threads.append(thread)
-        thread.start()
+        jobs.append((thread_execute_on_connection,
+                     (host, 'Shutting down',
+                      get_deploy_command(host, remote_config, 'shutdown'))))
 
-    for thread in threads:
-        thread.join()
+    run_jobs(jobs)
 
     # Sequentially shut down any masters
     for host in masters:
-        connection = get_connection(config, host)
-        thread_execute_on_connection(connection, 'Shutting down', args)
+        thread_execute_on_connection(host, 'Shutting down',
+                                     get_deploy_command(host, remote_config, 'shutdown'))
 
 
-def thread_update_zoidberg_deploy(target, local_config, remote_config):
-    '''Worker for zoidberg deploy threads'''
-    print('START copy zoidberg-deploy to ' + target)
+def thread_push_source(target, source_uri, branch):
+    '''Pushes a locally fetched source branch into the target's git cache'''
+    report('START', 'push ' + source_uri + ' to', target)
+    try:
+        env = dict(os.environ)
+        env['GIT_SSH_COMMAND'] = ' '.join(['ssh'] + get_ssh_options())
+        name = get_git_cache_name(source_uri)
+        subprocess.check_call(['git', 'push', '-q', host_connections[target] + ':' +
+                               get_target_path(target, '.git-cache/' + name),
+                               '+refs/heads/' + branch + ':refs/heads/' + branch],
+                              stderr=subprocess.STDOUT, cwd=local_git_cache + '/' + name, env=env)
+        report('OK', 'push ' + source_uri + ' to', target)
+        return True
+    except Exception as e:
+        report('ERROR', 'push ' + source_uri + ' to', target, e)
+        return False
+
+
+def thread_push_wheelhouse(target, wheelhouse):
+    '''Syncs a local directory of wheels to the target, for pip to install from'''
+    report('START', 'push wheels to', target)
     try:
         subprocess.check_call(
-            ['scp', 'zoidberg-deploy.py', target + ':' + target_script], stderr=subprocess.STDOUT)
-        subprocess.check_call(
-            ['scp', local_config, target + ':' + remote_config], stderr=subprocess.STDOUT)
-        subprocess.check_call(['ssh', target, 'chmod', '+x', target_script],
-                              stderr=subprocess.STDOUT)
-        print('OK copy zoidberg-deploy to ' + target)
+            ['rsync', '-a', '--delete', '-e', ' '.join(['ssh'] + get_ssh_options()),
+             os.path.join(wheelhouse, ''), host_connections[target] + ':' + get_target_path(target, 'wheels')],
+            stderr=subprocess.STDOUT)
+        report('OK', 'push wheels to', target)
+        return True
     except Exception as e:
-        print(e)
-        print('ERROR copy zoidberg-deploy to ' + target)
+        report('ERROR', 'push wheels to', target, e)
+        return False
+
+
+def thread_update_zoidberg_deploy(target, upload):
+    '''Worker for zoidberg deploy threads
+
+    Files are kept in a content addressed cache on the target, so a single
+    round trip finds out what is missing and only those files are copied.
+    The same round trip prepares the target's git caches for any sources
+    being pushed to it.'''
+    uploads = [(local_path, get_target_path(target, remote_path))
+               for local_path, remote_path in upload['uploads']]
+    sources = upload['sources']
+    # The node's compiled configs are named after content addressed config
+    # paths too, so they age out along with the files themselves
+    target_caches = shlex.quote(get_target_path(target, 'cache')) + ' ' + \
+        shlex.quote(get_target_path(target, '.cache/configs'))
+
+    report('START', 'copy zoidberg-deploy to', target)
+    try:
+        check = 'mkdir -p ' + target_caches + ' && find ' + target_caches + \
+            ' -type f -mtime +' + str(cache_max_age_days) + ' -delete'
+        for _, remote_path in uploads:
+            quoted = shlex.quote(remote_path)
+            check += ' && { [ -e ' + quoted + ' ] && touch ' + \
+                quoted + ' || echo ' + quoted + '; }'
+        for source_uri, _ in sources:
+            quoted = shlex.quote(get_target_path(target, '.git-cache/' +
+                                                 get_git_cache_name(source_uri)))
+            check += ' && { [ -d ' + quoted + ' ] || git init -q --bare ' + quoted + \
+                '; } && git -C ' + quoted + ' config receive.shallowUpdate true'
+
+        started = time.time()
+        missing = subprocess.check_output(
+            get_ssh_command(target, [check])).decode().split()
+        report_time('check deploy cache', target, started)
+
+        for local_path, remote_path in uploads:
+            if remote_path not in missing:
+                continue
+
+            started = time.time()
+            # Hosts sharing a machine and root can upload the same file at once
+            temp_path = shlex.quote(remote_path + '.' + str(os.getpid()) + '.' +
+                                    str(threading.get_ident()))
+            with open(local_path, 'rb') as stream:
+                subprocess.check_call(
+                    get_ssh_command(target, ['cat > ' + temp_path + ' && mv ' + temp_path +
+                                             ' ' + shlex.quote(remote_path)]),
+                    stdin=stream, stderr=subprocess.STDOUT)
+            report_time('upload ' + os.path.basename(local_path), target, started)
+
+        report('OK', 'copy zoidberg-deploy to', target)
+        log(str(len(missing)) + ' of ' + str(len(uploads)) + ' files changed on ' + target)
+    except Exception as e:
+        report('ERROR', 'copy zoidberg-deploy to', target, e)
+        return False
+
+    pushed = [thread_push_source(target, source_uri, branch)
+              for source_uri, branch in sources]
+
+    if upload['wheelhouse'] is not None:
+        pushed.append(thread_push_wheelhouse(target, upload['wheelhouse']))
+
+    return all(pushed)
+
+
+def ensure_zoidberg_deploy(host):
+    '''Performs the pending zoidberg deploy upload for a host, at most once per run'''
+    ensure_connection(host)
+
+    with deploy_uploads_lock:
+        upload = deploy_uploads.get(host)
+
+    if upload is None:
+        return True
+
+    with upload['lock']:
+        if upload['ok'] is None:
+            upload['ok'] = thread_update_zoidberg_deploy(host, upload)
+        return upload['ok']
 
 
 def update_zoidberg_deploy(config, hosts, local_config, remote_config):
-    '''Updates zoidberg deploy script on specified hosts'''
-    threads = []
+    '''Updates zoidberg deploy script on specified hosts
+
+    The copy is queued rather than performed here, so each host uploads as
+    part of its first job and moves straight on to its command.'''
+    uploads = [('zoidberg-deploy.py', target_script),
+               (local_config, remote_config)]
+
+    with deploy_uploads_lock:
+        for host in hosts:
+            deploy_uploads[host] = {
+                'lock': threading.Lock(),
+                'ok': None,
+                'uploads': uploads,
+                'sources': [],
+                'wheelhouse': None
+            }
+
+
+def push_wheelhouse(config, hosts, wheelhouse):
+    '''Queues syncing a local wheelhouse to the hosts along with zoidberg deploy'''
+    with deploy_uploads_lock:
+        for host in hosts:
+            deploy_uploads[host]['wheelhouse'] = wheelhouse
+
+
+def thread_fetch_local_source(source_uri, branch):
+    '''Fetches the tip of a source branch into the controller's git cache'''
+    cache_dir = local_git_cache + '/' + get_git_cache_name(source_uri)
+    report('START', 'fetch ' + source_uri + ' ' + branch)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+            subprocess.check_call(['git', 'init', '-q', '--bare'],
+                                  stderr=subprocess.STDOUT, cwd=cache_dir)
+        subprocess.check_call(['git', 'fetch', '-q', '--depth', '1', source_uri,
+                               '+refs/heads/' + branch + ':refs/heads/' + branch],
+                              stderr=subprocess.STDOUT, cwd=cache_dir)
+        report('OK', 'fetch ' + source_uri + ' ' + branch)
+    except Exception as e:
+        report('ERROR', 'fetch ' + source_uri + ' ' + branch, error=e)
+
+
+def push_sources(config, hosts, services):
+    '''Fetches every source the services need once on the controller, and
+    queues pushing them to the git caches of the hosts that use them'''
+    host_sources = dict()
 
     for host in hosts:
-        connection = get_connection(config, host)
-        thread = threading.Thread(
-            target=thread_update_zoidberg_deploy, args=(connection, local_config, remote_config))
-        threads.append(thread)
-        thread.start()
+        host_sources[host] = set()
+        for service in get_services_for_host(config, host, services):
+            service_config = config['services'][service]
+            if 'source' not in service_config or service_config['source'] not in config['sources']:
+                continue
+
+            source_config = config['sources'][service_config['source']]
+            host_sources[host].add(
+                (source_config['source'], get_source_branch(source_config)))
 
-    for thread in threads:
-        thread.join()
+    all_sources = set()
+    for sources in host_sources.values():
+        all_sources.update(sources)
+
+    run_jobs([(thread_fetch_local_source, source) for source in sorted(all_sources)])
+
+    with deploy_uploads_lock:
+        for host in hosts:
+            deploy_uploads[host]['sources'] = sorted(host_sources[host])
 
 
 def sanitise_services(config, input_services):
@@ -234,7 +1793,7 @@ def sanitise_services(config, input_services):
         if service in config['services']:
             services.add(service)
         else:
-            print('Ignoring un-recognised service "' + service + '"')
+            log('Ignoring un-recognised service "' + service + '"')
 
     return services
 
@@ -247,66 +1806,378 @@ def get_affected_hosts(config, services):
         services = config['services'].keys()
 
     for service in services:
-        host = config['services'][service]['host']
+        host = config['_index']['service_host'][service]
         if host in config['hosts']:
             hosts.add(host)
         else:
-            print('Ignoring unknown host "' + host + '"')
+            log('Ignoring unknown host "' + host + '"')
 
     return hosts
 
 
-if __name__ == '__main__':
-    print('(V) (°,,,,°) (V)')
+def get_plan_step_args(operation, args):
+    '''Gets the zoidberg deploy arguments for one operation in a plan'''
+    step_args = []
+
+    if operation == 'update':
+        if args.restart:
+            step_args.append('-r')
+        if args.force:
+            step_args.append('--force')
+        if args.only_changed:
+            step_args.append('--only-changed')
+    elif operation == 'status':
+        if args.compact:
+            step_args.append('--compact')
+    elif operation == 'install':
+        if not args.no_prereqs:
+            step_args.append('-p')
+        if args.refresh_prereqs:
+            step_args.append('--refresh-prereqs')
+        if args.wheelhouse is not None:
+            step_args.append('--wheels')
+
+    return step_args + remote_args
+
+
+def run_plan(config, remote_config, hosts, services, operations, args, use_daemon):
+    '''Runs a chain of operations on each host in a single session with the
+    zoidberg deploy agent, or with the node daemon if asked to use it. Each
+    host works through the chain on its own, so depends_on only orders the
+    services within each host.'''
+    for operation in operations:
+        if operation not in chainable_operations:
+            report('ERROR', operation + ' can\'t be chained with other operations')
+            return
+
+    try:
+        waves = get_service_waves(config, services)
+    except Exception as e:
+        report('ERROR', 'order services', error=e)
+        return
+
+    if 'install' in operations and args.wheelhouse is not None:
+        push_wheelhouse(config, hosts, args.wheelhouse)
+
+    description = 'Running ' + ', '.join(operations)
+    jobs = []
+
+    for host in hosts:
+        host_services = get_services_for_host(config, host, services)
+
+        if len(host_services) == 0:
+            continue
+
+        plan = []
+        for operation in operations:
+            if operation == 'run':
+                operation = 'start'
+
+            step = {'operation': operation,
+                    'args': get_plan_step_args(operation, args)}
+
+            if operation in ['start', 'stop', 'restart']:
+                host_waves = [[service for service in wave if service in host_services]
+                              for wave in waves]
+                if operation == 'stop':
+                    host_waves.reverse()
+
+                for wave in host_waves:
+                    if len(wave) > 0:
+                        plan.append(dict(step, services=wave))
+            else:
+                plan.append(dict(step, services=host_services))
+
+        step_config = get_target_path(host, remote_config)
+        # A resumed run carries on from the first operation that didn't succeed
+        plan = plan[get_resumed_plan_steps(host, len(plan)):]
+        if len(plan) == 0:
+            continue
+
+        plan_lines = ''.join(json.dumps(dict(step, config=step_config)) + '\n'
+                             for step in plan)
+        jobs.append((thread_execute_on_daemon if use_daemon else thread_execute_on_connection,
+                     (host, description,
+                      get_deploy_command(host, remote_config, 'agent'), plan_lines.encode())))
+
+    run_jobs(jobs)
 
+
+def get_resumed_plan_steps(host, steps):
+    '''Gets how many steps of a host's chain a resumed run can skip, noting
+    it in the journal'''
+    if journal is None:
+        return 0
+
+    with journal_lock:
+        entry = journal['hosts'].get(host)
+        if entry is None or entry['plan_steps_done'] >= steps:
+            return 0
+        entry['plan_offset'] = entry['plan_steps_done']
+        return entry['plan_offset']
+
+
+def daemon_start(config, remote_config, hosts):
+    '''Starts the node daemon on the specified hosts, replacing any running ones'''
+    jobs = []
+
+    for host in hosts:
+        target_run = get_target_path(host, 'run')
+        command = ['mkdir', '-p', shlex.quote(target_run), ';',
+                   'pkill', '-f', get_daemon_pattern(host), ';', 'nohup'] + \
+            get_deploy_command(host, remote_config, 'daemon') + \
+            ['>', shlex.quote(target_run + '/daemon.log'), '2>&1', '<', '/dev/null', '&']
+        jobs.append((thread_execute_on_connection, (host, 'Starting daemon', command)))
+
+    run_jobs(jobs)
+
+
+def daemon_stop(config, hosts):
+    '''Stops any node daemons on the specified hosts'''
+    jobs = []
+
+    for host in hosts:
+        command = ['pkill', '-f', get_daemon_pattern(host), ';', 'true']
+        jobs.append((thread_execute_on_connection, (host, 'Stopping daemon', command)))
+
+    run_jobs(jobs)
+
+
+def run_operation(config, remote_config, hosts, services, args):
+    '''Dispatches the requested operation'''
+    operations = args.operation.split(',')
+    use_daemon = args.daemon or get_setting(config, 'use_daemon', False)
+    rolling = args.rolling if args.rolling is not None else get_setting(config, 'rolling')
+    if rolling is not None:
+        rolling = str(rolling)
+
+    if len(operations) > 1 or (use_daemon and operations[0] in chainable_operations):
+        # A chain that restarts services is rolled out like a lone restart,
+        # the whole chain at a time on each batch
+        restarts = any(operation in ['restart', 'rollback'] or (operation == 'update' and args.restart)
+                       for operation in operations)
+        if rolling is not None and restarts:
+            execute_rolling(config, remote_config, hosts, services, rolling,
+                            'Rolling ' + ', '.join(operations),
+                            lambda batch: run_plan(config, remote_config, batch, services,
+                                                   operations, args, use_daemon))
+        else:
+            run_plan(config, remote_config, hosts, services,
+                     operations, args, use_daemon)
+    elif args.operation == 'daemon-start':
+        daemon_start(config, remote_config, hosts)
+    elif args.operation == 'daemon-stop':
+        daemon_stop(config, hosts)
+    elif args.operation in ['start', 'run']:
+        start(config, remote_config, hosts, services)
+    elif args.operation == 'stop':
+        stop(config, remote_config, hosts, services)
+    elif args.operation == 'restart':
+        restart(config, remote_config, hosts, services, rolling)
+    elif args.operation == 'status':
+        status(config, remote_config, hosts, services, args.compact)
+    elif args.operation == 'update':
+        update(config, remote_config, hosts, services,
+               args.restart, args.force, args.only_changed, rolling)
+    elif args.operation == 'rollback':
+        rollback(config, remote_config, hosts, services, rolling)
+    elif args.operation == 'health':
+        health(config, remote_config, hosts, services)
+    elif args.operation == 'sideload':
+        sideload(config, remote_config, hosts,
+                 services, args.source, args.restart)
+    elif args.operation == 'watch':
+        watch(config, remote_config, hosts, services, args.source)
+    elif args.operation == 'install':
+        install(config, remote_config, hosts, services,
+                args.no_prereqs, args.refresh_prereqs, args.wheelhouse)
+    elif args.operation == 'install-prereqs':
+        install_prereqs(config, remote_config, hosts)
+    elif args.operation == 'shutdown':
+        shutdown(config, remote_config, hosts)
+    elif args.operation == 'ping':
+        ping(config, remote_config, hosts, services)
+    else:
+        raise(Exception('Unknown operation'))
+
+
+if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('config', help='Path to config YAML file')
-    parser.add_argument('operation', help='Operation to execute')
+    parser.add_argument('operation', help='Operation to execute, or a comma separated chain of them')
     parser.add_argument('services', nargs='*',
                         help='Optional subset services to act on')
     parser.add_argument(
-        '--source', nargs='?', help='Sideload: Source path for sideload operation', type=str, default=None)
+        '--source', nargs='?', help='Sideload, Watch: Source path for sideload operation', type=str, default=None)
     parser.add_argument('-r', '--restart', action='store_true',
                         help='Update, Sideload: Also restart the systemctl service after the operation')
     parser.add_argument('-p', '--no-prereqs', action='store_false',
                         help='Install: Don\'t install the prerequisites')
+    parser.add_argument('--refresh-prereqs', action='store_true',
+                        help='Install: Check every prerequisite on the nodes again, rather than trusting their record of what is installed')
+    parser.add_argument('--wheelhouse', type=str, default=None,
+                        help='Install: Local directory of wheels to ship to the nodes for pip to install from')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Update: Run the update scripts and restart even for sources that haven\'t changed')
+    parser.add_argument('--only-changed', action='store_true',
+                        help='Update: Only report on sources that changed')
+    parser.add_argument('--push-sources', action='store_true',
+                        help='Install, Update: Fetch sources on this machine and push them to the nodes, instead of each node fetching them')
+    parser.add_argument('--keep-alive', nargs='?', type=int, const=600, default=None,
+                        help='Keep the ssh connections open for this many seconds after the run, for reuse by later runs')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Send commands to the node daemons started with daemon-start, where they are running')
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='Maximum number of hosts to work on at once')
+    parser.add_argument('--systemctl-mode', choices=['batch', 'concurrent', 'serial'], default=None,
+                        help='How nodes run systemctl for their services: one call per batch of units, concurrently, or serially')
+    parser.add_argument('--rolling', type=str, default=None,
+                        help='Restart, Update -r, Rollback: Work through the hosts N, or N%%, at a time, checking the services are healthy before moving on')
+    parser.add_argument('--compact', action='store_true',
+                        help='Status: Show a table of each service\'s state, uptime and memory, cached for a few seconds')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print where the time of the run went, and how it compares with the last same run')
+    parser.add_argument('--json', action='store_true',
+                        help='Print JSON lines of events, output and a final summary instead of text')
+    parser.add_argument('--resume', type=str, default=None, metavar='RUN_ID',
+                        help='Carry on with an earlier run of the same operation, only going back to the hosts that didn\'t finish')
     args = parser.parse_args()
 
-    print('Parsing configuration file "' + args.config + '"')
-    config_stream = open(args.config, 'r')
-    config = yaml.safe_load(config_stream)
+    json_output = args.json
+    if not json_output:
+        print('(V) (°,,,,°) (V)')
+
+    # Nodes report their steps as events for the summary
+    remote_args.append('--events')
+
+    if args.keep_alive is not None:
+        control_persist = str(args.keep_alive)
+
+    if args.rolling is not None and not re.match(rolling_pattern, args.rolling):
+        parser.error('--rolling must be a number of hosts, or a percentage of them')
+
+    if args.systemctl_mode is not None:
+        remote_args += ['--systemctl-mode', args.systemctl_mode]
+
+    log('Parsing configuration file "' + args.config + '"')
+    config = load_config(args.config)
+
+    # Catch mistakes in the config before touching any hosts
+    problems = validate_config(config)
+    for problem in problems:
+        report('ERROR', 'Invalid config: ' + problem)
+    if len(problems) > 0:
+        summarise()
+        sys.exit(1)
+
+    for operation in args.operation.split(','):
+        if operation not in known_operations:
+            parser.error('Unknown operation ' + operation)
+
+    if args.operation == 'plan':
+        # plan takes the operations to plan in place of the first service
+        operations = args.services.pop(0).split(',') if len(args.services) > 0 else ['install']
+        for operation in operations:
+            if operation not in known_operations or operation == 'plan':
+                parser.error('Can\'t plan unknown operation ' + operation)
+        services = sanitise_services(config, args.services)
+        if len(args.services) > 0 and len(services) == 0:
+            log('All your specified services are missing, stopping')
+            exit(1)
+        plan(config, get_affected_hosts(config, services), services, operations, args)
+        sys.exit(0)
+
+    previous_journal = None
+    if args.resume is not None:
+        previous_journal = load_journal(args.resume)
+        if previous_journal is None:
+            log('There is no run ' + args.resume + ' to resume')
+            sys.exit(1)
+        if previous_journal['operation'] != args.operation or \
+                previous_journal['config'] != os.path.abspath(args.config):
+            log('Run ' + args.resume + ' was ' + previous_journal['operation'] + ' with ' +
+                previous_journal['config'] + ', so it can\'t be resumed by this one')
+            sys.exit(1)
+        if len(args.services) == 0:
+            args.services = previous_journal['services']
 
     services = sanitise_services(config, args.services)
 
     if len(args.services) > 0 and len(services) == 0:
-        print('All your specified services are missing, stopping')
+        log('All your specified services are missing, stopping')
         exit(1)
 
     affected_hosts = get_affected_hosts(config, services)
-    remote_config = get_temp_target_config()
-    update_zoidberg_deploy(config, affected_hosts, args.config, remote_config)
 
-    if args.operation in ['start', 'run']:
-        start(config, remote_config, affected_hosts, services)
-    elif args.operation == 'stop':
-        stop(config, remote_config, affected_hosts, services)
-    elif args.operation == 'restart':
-        restart(config, remote_config, affected_hosts, services)
-    elif args.operation == 'status':
-        status(config, remote_config, affected_hosts, services)
-    elif args.operation == 'update':
-        update(config, remote_config, affected_hosts, services, args.restart)
-    elif args.operation == 'sideload':
-        sideload(config, remote_config, affected_hosts,
-                 services, args.source, args.restart)
-    elif args.operation == 'install':
-        install(config, remote_config, affected_hosts,
-                services, args.no_prereqs)
-    elif args.operation == 'install-prereqs':
-        install_prereqs(config, remote_config, affected_hosts)
-    elif args.operation == 'shutdown':
-        shutdown(config, remote_config, affected_hosts)
-    elif args.operation == 'ping':
-        ping(config, remote_config, affected_hosts, services)
-    else:
-        raise(Exception('Unknown operation'))
+    if previous_journal is not None:
+        affected_hosts = [host for host in affected_hosts if not is_host_done(
+            previous_journal['hosts'].get(host))]
+        if len(affected_hosts) == 0:
+            log('Every host finished run ' + args.resume + ', nothing to resume')
+            sys.exit(0)
+        log('RESUME ' + args.resume + ' on ' + str(len(affected_hosts)) + ' hosts')
+    show_status_table = args.compact and 'status' in args.operation.split(',')
+
+    if show_status_table and args.operation == 'status':
+        cached = load_cached_status(config, args.config, services)
+        if cached is not None:
+            rows, age = cached
+            print_status_table(rows, age)
+            if not all(row['active'] == 'active' for row in rows):
+                sys.exit(1)
+            sys.exit(0)
+    target_script = get_cached_target_path(
+        'zoidberg-deploy.py', 'zoidberg-deploy', '.py')
+    remote_config = get_cached_target_path(args.config, 'config', '.yaml')
+    load_host_layouts(config, affected_hosts)
+    retries = max(0, int(get_setting(config, 'retries', default_retries)))
+    retry_backoff = get_setting(config, 'retry_backoff', default_retry_backoff)
+    start_journal(config, args.config, args.operation, args.services, affected_hosts, previous_journal)
+    log('RUN ' + journal['id'])
+    run_started = time.time()
+    connect_timeout = int(get_setting(config, 'connect_timeout', default_connect_timeout))
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    start_executor(config, args.parallel)
+
+    try:
+        update_zoidberg_deploy(config, affected_hosts, args.config, remote_config)
+
+        if any(operation in ['install', 'update'] for operation in args.operation.split(',')) and \
+                (args.push_sources or get_setting(config, 'push_sources', False)):
+            push_sources(config, affected_hosts, services)
+            remote_args.append('--offline')
+
+        run_operation(config, remote_config, affected_hosts, services, args)
+    finally:
+        if args.keep_alive is None:
+            close_connections(config, affected_hosts)
+        executor.shutdown()
+        save_journal(True)
+
+    if show_status_table:
+        rows = get_status_rows()
+        print_status_table(rows)
+
+        # Only cache a complete picture of the fleet
+        if not any(event['status'] == 'ERROR' and event['origin'] == 'controller' for event in events):
+            save_cached_status(args.config, services, rows)
+
+    ok = summarise()
+    if show_status_table and not all(row['active'] == 'active' for row in get_status_rows()):
+        ok = False
+
+    finish_journal(ok)
+    if not ok:
+        log('Carry on with the hosts that didn\'t finish using --resume ' + journal['id'])
+
+    profile = build_profile(args.config, args.operation, run_started, ok)
+    previous = load_previous_profile(profile)
+    try:
+        save_profile(config, profile)
+    except Exception as e:
+        log('Couldn\'t save the profile: ' + str(e))
+    if args.profile:
+        print_profile(profile, previous)
+
+    if not ok:
+        sys.exit(1)